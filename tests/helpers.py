@@ -0,0 +1,17 @@
+import importlib.util
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_modules = {}
+
+
+def load_script(filename):
+    """Imports one of the repo's scripts by file name (many have dashes)."""
+    if filename not in _modules:
+        name = os.path.splitext(filename)[0].replace("-", "_")
+        spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, filename))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _modules[filename] = module
+    return _modules[filename]
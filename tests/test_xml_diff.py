@@ -0,0 +1,65 @@
+import itertools
+import random
+import sys
+import unittest
+from unittest import mock
+
+from helpers import load_script
+
+
+class _SlowClock:
+    """Stands in for the time module: every reading is 10s after the last."""
+
+    def __init__(self):
+        self._ticks = itertools.count(0, 10)
+
+    def time(self):
+        return next(self._ticks)
+
+
+class HtmlDiffRowsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mod = load_script("xml-diff.py")
+
+    def test_large_input_marks_only_the_edits(self):
+        rng = random.Random(0)
+        left = ["<line>{}</line>".format(i) for i in range(60000)]
+        picked = rng.sample(range(len(left)), 1100)
+        edited, deleted = set(picked[:800]), set(picked[800:])
+        right = [
+            "<line>{} edited</line>".format(i) if i in edited else line
+            for i, line in enumerate(left) if i not in deleted
+        ]
+
+        # However slow the host, the line diff must not give up early and
+        # mark whole stretches as changed
+        dmp_module = sys.modules[self.mod.diff_match_patch.__module__]
+        with mock.patch.object(dmp_module, "time", _SlowClock()):
+            rows = [row for _, row in self.mod.iter_html_diff_rows(left, right)]
+
+        added = sum('class="diff_add"' in row for row in rows)
+        removed = sum('class="diff_sub"' in row for row in rows)
+        self.assertEqual(added, 800)
+        self.assertEqual(removed, 1100)
+
+
+class CollapseRowsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mod = load_script("xml-diff.py")
+
+    def test_folds_long_unmodified_runs_only(self):
+        left = ["<a>{}</a>".format(i) for i in range(20)]
+        right = left[:3] + ["<b/>"] + left[3:]
+        rows = list(self.mod.collapse_rows(self.mod.iter_html_diff_rows(left, right)))
+
+        folded = [row for row in rows if "unchanged lines" in row]
+        self.assertEqual(len(folded), 1)
+        self.assertIn("Show 17 unchanged lines", folded[0])
+        # the three rows before the insert stay visible
+        self.assertEqual(rows.index(folded[0]), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+
+from helpers import load_script
+
+
+class ContextBlocksTest(unittest.TestCase):
+
+    def blocks(self, before, after):
+        mod = load_script("xml-html-diff.py")
+        return [(list(left), list(right))
+                for left, right in mod.build_context_blocks(before, after)]
+
+    def test_attribute_added(self):
+        self.assertEqual(self.blocks(
+            b'<r><a>hello world text</a><b>x</b></r>',
+            b'<r><a y="2">hello world text</a><b>x</b></r>'
+        ), [(['<r>', '  <a>hello world text</a>', '</r>'],
+             ['<r>', '  <a y="2">hello world text</a>', '</r>'])])
+
+    def test_attribute_removed(self):
+        self.assertEqual(self.blocks(
+            b'<r><a x="1">hello world text</a><b>x</b></r>',
+            b'<r><a>hello world text</a><b>x</b></r>'
+        ), [(['<r>', '  <a x="1">hello world text</a>', '</r>'],
+             ['<r>', '  <a>hello world text</a>', '</r>'])])
+
+    def test_renamed_node(self):
+        self.assertEqual(self.blocks(b'<r><a>1</a></r>', b'<r><b>1</b></r>'),
+                         [(['<r>', '  <a>1</a>', '</r>'],
+                           ['<r>', '  <b>1</b>', '</r>'])])
+
+    def test_no_unhandled_actions(self):
+        blocks = self.blocks(
+            b'<r><a>1</a><b>2</b><c><d>q</d><e/></c>t</r>',
+            b'<r><b>2</b><a>1</a><c><e/><d>q</d></c>u</r>'
+        )
+        self.assertTrue(blocks)
+        for left, right in blocks:
+            self.assertNotIn("unhandled", "".join(left + right))
+
+
+if __name__ == "__main__":
+    unittest.main()
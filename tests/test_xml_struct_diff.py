@@ -0,0 +1,57 @@
+import unittest
+
+from helpers import load_script
+
+# Deeper than Python's default recursion limit
+DEPTH = 1200
+
+SCRIPTS = ("xml_struct_diff-2.py", "xml_struct_diff-4.py", "xml_struct_diff-5.py")
+
+
+def nested(depth, leaf):
+    return "<n>" * depth + leaf + "</n>" * depth
+
+
+class DeepNestingTest(unittest.TestCase):
+
+    def diff(self, script, before, after):
+        mod = load_script(script)
+        return mod.FilterModule().xml_struct_diff(before, after)
+
+    def test_deep_text_edit(self):
+        for script in SCRIPTS:
+            with self.subTest(script=script):
+                result = self.diff(script, nested(DEPTH, "x"), nested(DEPTH, "y"))
+                self.assertEqual(result["metadata"], {
+                    "changed": True,
+                    "added_count": 0,
+                    "removed_count": 0,
+                    "changed_count": 1
+                })
+
+    def test_deep_equal_documents(self):
+        for script in SCRIPTS:
+            with self.subTest(script=script):
+                result = self.diff(script, nested(DEPTH, "x"), nested(DEPTH, "x"))
+                self.assertFalse(result["metadata"]["changed"])
+
+
+class EntityTest(unittest.TestCase):
+
+    def diff(self, script, before, after):
+        mod = load_script(script)
+        return mod.FilterModule().xml_struct_diff(before, after)
+
+    def test_only_internal_entities_are_expanded(self):
+        internal = '<!DOCTYPE r [<!ENTITY e "expanded">]><r><x>&e;</x></r>'
+        external = '<!DOCTYPE r [<!ENTITY e SYSTEM "file:///etc/passwd">]><r><x>&e;</x></r>'
+        for script in ("xml_struct_diff-8.py", "xml_struct_diff-9.py", "xml_struct_diff-10.py"):
+            with self.subTest(script=script):
+                result = self.diff(script, internal, "<r><x/></r>")
+                self.assertIn("expanded", result["left"])
+                result = self.diff(script, external, "<r><x/></r>")
+                self.assertNotIn("root:", result["left"])
+
+
+if __name__ == "__main__":
+    unittest.main()
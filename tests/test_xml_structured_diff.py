@@ -0,0 +1,55 @@
+import os
+import signal
+import time
+import unittest
+
+from helpers import load_script
+
+
+class StructuredDiffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mod = load_script("xml_structured_diff.py")
+
+    def test_known_edit_is_reported(self):
+        result = self.mod.structured_xml_diff(
+            "<r><a>1</a><b>x</b></r>",
+            "<r><a>2</a><c>y</c></r>"
+        )
+        self.assertTrue(any(result.values()), result)
+
+    def test_leaf_text_edit_is_one_change(self):
+        result = self.mod.structured_xml_diff("<r><a>1</a></r>", "<r><a>2</a></r>")
+        self.assertEqual(result, {
+            "added": [],
+            "deleted": [],
+            "changed": [{"path": "/r/a[1]", "old": "1", "new": "2"}],
+            "moved": []
+        })
+
+    def test_equal_documents(self):
+        result = self.mod.structured_xml_diff('<r xmlns="urn:x"><a>1</a></r>', "<r><a>1</a></r>")
+        self.assertEqual(result, {"added": [], "deleted": [], "changed": [], "moved": []})
+
+    def test_fork_after_use(self):
+        # Ansible forks its workers after the plugin may already have run
+        self.mod.structured_xml_diff("<r><a>1</a></r>", "<r><a>2</a></r>")
+        # let any parse threads go idle, as they would between tasks
+        time.sleep(0.2)
+
+        pid = os.fork()
+        if pid == 0:
+            signal.alarm(10)
+            status = 1
+            try:
+                self.mod.structured_xml_diff("<r><a>3</a></r>", "<r><a>4</a></r>")
+                status = 0
+            finally:
+                os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        self.assertTrue(os.WIFEXITED(status))
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
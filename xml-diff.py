@@ -1,17 +1,111 @@
-from xmldiff import main, formatting
+from xmldiff import main, actions
+from diff_match_patch import diff_match_patch
 from lxml import etree
-import difflib
+from html import escape
+from functools import lru_cache
+from itertools import zip_longest
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+import os
+import re
+
+
+_HTML_HEAD = """<!DOCTYPE html>
+<html>
+<head>
+    <meta http-equiv="Content-Type" content="text/html; charset=utf-8" />
+    <title></title>
+    <style type="text/css">
+        table.diff {{font-family:Courier; border:medium;}}
+        .diff_header {{background-color:#e0e0e0}}
+        td.diff_header {{text-align:right}}
+        .diff_add {{background-color:#aaffaa}}
+        .diff_sub {{background-color:#ffaaaa}}
+    </style>
+</head>
+<body>
+    <table class="diff" cellspacing="0" cellpadding="0" rules="groups">
+        <colgroup></colgroup> <colgroup></colgroup>
+        <colgroup></colgroup> <colgroup></colgroup>
+        <thead><tr><th colspan="2" class="diff_header">{fromdesc}</th><th colspan="2" class="diff_header">{todesc}</th></tr></thead>
+        <tbody>"""
+
+_HTML_TAIL = """        </tbody>
+    </table>
+</body>
+</html>"""
+
+
+# Shared by every parse in this module. huge_tree lifts libxml2's depth and
+# text-size limits for very large configs; entities are never expanded.
+_PARSER = etree.XMLParser(
+    remove_blank_text=True,
+    collect_ids=False,
+    huge_tree=True,
+    resolve_entities=False,
+)
+
+
+def pretty_lines_from_root(root):
+    # serialize straight to UTF-8 and decode once; split on "\n" only, since
+    # str.splitlines() would also break on U+2028 & co. inside text nodes
+    formatted = etree.tostring(root, pretty_print=True, encoding="utf-8")
+    lines = formatted.decode("utf-8").split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return lines
 
 
 def pretty_lines(xml_str: str):
-    parser = etree.XMLParser(remove_blank_text=True)
-    root = etree.fromstring(xml_str, parser=parser)
-    formatted = etree.tostring(root, pretty_print=True, encoding="unicode")
-    return formatted.splitlines()
+    root = etree.fromstring(xml_str, parser=_PARSER)
+    return pretty_lines_from_root(root)
+
+
+@lru_cache(maxsize=1024)
+def compiled_xpath(xpath):
+    return etree.XPath(xpath)
+
+
+_STEP_RE = re.compile(r"([A-Za-z_][\w.\-]*)(?:\[(\d+)\])?$")
+
+
+def resolve_path(root, xpath):
+    """
+    Resolve an absolute path such as /config/foo[3]/bar by walking children
+    directly. Anything beyond plain name[idx] steps (//, @, *, functions,
+    prefixes) is handed to the compiled XPath instead.
+    """
+    steps = xpath.split("/")
+    if steps[0] or "//" in xpath:
+        return compiled_xpath(xpath)(root)
+
+    matches = []
+    for step in steps[1:]:
+        m = _STEP_RE.match(step)
+        if not m:
+            return compiled_xpath(xpath)(root)
+        matches.append((m.group(1), int(m.group(2)) if m.group(2) else None))
+
+    tag, idx = matches[0]
+    doc_root = root.getroottree().getroot()
+    current = [doc_root] if doc_root.tag == tag and idx in (None, 1) else []
+
+    for tag, idx in matches[1:]:
+        found = []
+        for parent in current:
+            if idx is None:
+                found.extend(parent.iterchildren(tag))
+            else:
+                for pos, child in enumerate(parent.iterchildren(tag), 1):
+                    if pos == idx:
+                        found.append(child)
+                        break
+        current = found
+    return current
 
 
 def xml_at_path(root, xpath):
-    el = root.xpath(xpath)
+    el = resolve_path(root, xpath)
     if not el:
         return None
     return etree.tostring(el[0], pretty_print=True, encoding="unicode")
@@ -42,106 +136,225 @@ def _value_to_element_string(val):
         return None
 
 
+# Actions shown as an old/new pair of the element they touch
+_UPDATE_ACTIONS = (
+    actions.UpdateTextIn,
+    actions.UpdateTextAfter,
+    actions.UpdateAttrib,
+    actions.InsertAttrib,
+    actions.DeleteAttrib,
+    actions.RenameAttrib,
+    actions.RenameNode,
+)
+
+
 def build_visual_model(xml_before, xml_after):
 
-    # Structured XML diff
-    diff = main.diff_texts(
-        xml_before,
-        xml_after,
-        formatter=formatting.XmlDiffFormatter()
-    )
+    # Parse each side once; the same roots feed xmldiff, the baseline
+    # and the path lookups below
+    root_before = etree.fromstring(xml_before, _PARSER)
+    root_after = etree.fromstring(xml_after, _PARSER)
 
-    # Parse original trees
-    root_before = etree.fromstring(xml_before)
-    root_after = etree.fromstring(xml_after)
+    # Structured XML diff; no formatter → raw action namedtuples
+    diff_actions = main.diff_trees(root_before, root_after)
 
     # Baseline for left/right
-    left = pretty_lines(xml_before)
-    right = pretty_lines(xml_after)
+    left = pretty_lines_from_root(root_before)
+    right = pretty_lines_from_root(root_after)
 
     vis_left = left[:]   # copy baseline
     vis_right = right[:] # copy baseline
 
-    # Process structured changes
-    for change in diff:
-        ctype = change["type"]
+    # Trees are already parsed without blank text, so elements can be
+    # pretty-printed directly; cache per element for repeated changes
+    pretty_cache = {}
+
+    def pretty_elem(elem):
+        lines = pretty_cache.get(elem)
+        if lines is None:
+            lines = pretty_cache[elem] = pretty_lines_from_root(elem)
+        return lines
+
+    # Process structured changes, dispatched on the action class
+    for action in diff_actions:
+        kind = type(action)
 
         # DELETE: subtree removed
-        if ctype == "delete":
-            node = change["node"]
-            old = root_before.xpath(node)
+        if kind is actions.DeleteNode:
+            old = resolve_path(root_before, action.node)
             if old:
-                old_xml = etree.tostring(old[0], pretty_print=True, encoding="unicode")
-                for ln in pretty_lines(old_xml):
-                    vis_left.append(ln)
-                    vis_right.append("")
-
-        # INSERT: subtree added
-        elif ctype == "insert":
-            children = change.get("children", [])
-            for child in children:
-                xml_str = etree.tostring(child, pretty_print=True, encoding="unicode")
-                for ln in pretty_lines(xml_str):
-                    vis_left.append("")
-                    vis_right.append(ln)
-
-        # UPDATE: value changed
-        elif ctype == "update":
-            old_val = change.get("old", "")
-            new_val = change.get("new", "")
-            node = change["node"]
+                lines = pretty_elem(old[0])
+                vis_left.extend(lines)
+                vis_right.extend([""] * len(lines))
+
+        # INSERT: subtree added, as the position'th child of the target
+        elif kind is actions.InsertNode:
+            parents = resolve_path(root_after, action.target)
+            if parents and action.position < len(parents[0]):
+                lines = pretty_elem(parents[0][action.position])
+                vis_left.extend([""] * len(lines))
+                vis_right.extend(lines)
+
+        # UPDATE: text, attribute or tag changed
+        elif kind in _UPDATE_ACTIONS:
+            node = action.node
 
             # reconstruct the full element
-            old_node = root_before.xpath(node)
-            new_node = root_after.xpath(node)
-
-            old_xml = etree.tostring(old_node[0], pretty_print=True, encoding="unicode") if old_node else old_val
-            new_xml = etree.tostring(new_node[0], pretty_print=True, encoding="unicode") if new_node else new_val
+            old_node = resolve_path(root_before, node)
+            new_node = resolve_path(root_after, node)
 
-            old_lines = pretty_lines(old_xml)
-            new_lines = pretty_lines(new_xml)
+            # text updates carry the values themselves
+            old_lines = pretty_elem(old_node[0]) if old_node else [getattr(action, "oldtext", None) or ""]
+            new_lines = pretty_elem(new_node[0]) if new_node else [getattr(action, "text", None) or ""]
 
-            for i in range(max(len(old_lines), len(new_lines))):
-                vis_left.append(old_lines[i] if i < len(old_lines) else "")
-                vis_right.append(new_lines[i] if i < len(new_lines) else "")
+            # align both sides, padding the shorter one with blanks
+            pairs = list(zip_longest(old_lines, new_lines, fillvalue=""))
+            vis_left.extend(map(itemgetter(0), pairs))
+            vis_right.extend(map(itemgetter(1), pairs))
 
     return vis_left, vis_right
 
-def add_collapsible_sections(html, threshold=8):
-    rows = html.splitlines()
-    new_rows = []
-    buffer_block = []
-    unchanged_count = 0
-    in_table = False
-
-    for row in rows:
-        if "<tbody>" in row:
-            in_table = True
-        if "</tbody>" in row:
-            in_table = False
-
-        if in_table and 'class="diff_unmodified"' in row:
-            buffer_block.append(row)
-            unchanged_count += 1
-        else:
-            if unchanged_count >= threshold:
-                new_rows.append(
-                    f"<tr><td colspan='4' style='text-align:center;'>"
-                    f"<button onclick=\"this.nextElementSibling.style.display='block'; this.style.display='none';\">"
-                    f"Show {unchanged_count} unchanged lines..."
-                    f"</button></td></tr>"
-                )
-                new_rows.append("<tbody style='display:none;'>")
-                new_rows.extend(buffer_block)
-                new_rows.append("</tbody>")
+
+def _fold_header(count):
+    """Button row and hidden <tbody> opener placed before a folded run."""
+    return (
+        f"<tr><td colspan='4' style='text-align:center;'>"
+        f"<button onclick=\"this.nextElementSibling.style.display='block'; this.style.display='none';\">"
+        f"Show {count} unchanged lines..."
+        f"</button></td></tr>\n"
+        f"<tbody style='display:none;'>"
+    )
+
+
+def collapse_rows(rows, threshold=8):
+    """
+    Fold runs of at least `threshold` consecutive unmodified table rows
+    from iter_html_diff_rows behind a "Show N unchanged lines" button, and
+    drop the flags. Only the current run of unmodified rows is held in
+    memory.
+    """
+    run = []
+    for unmodified, row in rows:
+        if unmodified:
+            run.append(row)
+            continue
+
+        if run:
+            yield from _fold_run(run, threshold)
+            run = []
+        yield row
+
+    if run:
+        yield from _fold_run(run, threshold)
+
+
+def _fold_run(run, threshold):
+    if len(run) >= threshold:
+        yield _fold_header(len(run))
+        yield from run
+        yield "</tbody>"
+    else:
+        yield from run
+
+
+def _cell(lineno, text, css):
+    if lineno is None:
+        return '<td class="diff_header"></td><td nowrap="nowrap"></td>'
+    text = escape(text.expandtabs(4), quote=False).replace(" ", "&nbsp;")
+    return f'<td class="diff_header">{lineno}</td><td nowrap="nowrap"{css}>{text}</td>'
+
+
+def iter_html_diff_rows(left_lines, right_lines, fromdesc="", todesc=""):
+    """
+    Side-by-side HTML table of two line lists, using diff_match_patch in
+    line mode. Yields the document head, one string per table row and the
+    tail, so callers can stream them out without joining the whole page.
+    Each comes as an (unmodified, html) pair; unmodified is True only for
+    rows that are the same on both sides.
+    """
+    dmp = diff_match_patch()
+    # No time limit: past it the diff degrades to marking whole stretches
+    # of a large config as changed
+    dmp.Diff_Timeout = 0
+    chars_a, chars_b, line_array = dmp.diff_linesToChars(
+        "".join(ln + "\n" for ln in left_lines),
+        "".join(ln + "\n" for ln in right_lines),
+    )
+    diffs = dmp.diff_main(chars_a, chars_b, False)
+    dmp.diff_charsToLines(diffs, line_array)
+
+    yield False, _HTML_HEAD.format(fromdesc=escape(fromdesc), todesc=escape(todesc))
+    left_no = right_no = 0
+    deleted = []
+
+    def paired(inserted):
+        nonlocal left_no, right_no
+        for i in range(max(len(deleted), len(inserted))):
+            if i < len(deleted):
+                left_no += 1
+                left = _cell(left_no, deleted[i], ' class="diff_sub"')
             else:
-                new_rows.extend(buffer_block)
+                left = _cell(None, "", "")
+            if i < len(inserted):
+                right_no += 1
+                right = _cell(right_no, inserted[i], ' class="diff_add"')
+            else:
+                right = _cell(None, "", "")
+            yield False, f"<tr>{left}{right}</tr>"
+        deleted.clear()
+
+    for op, text in diffs:
+        lines = text.split("\n")[:-1]
+        if op == dmp.DIFF_DELETE:
+            deleted.extend(lines)
+        elif op == dmp.DIFF_INSERT:
+            yield from paired(lines)
+        else:
+            yield from paired([])
+            for ln in lines:
+                left_no += 1
+                right_no += 1
+                yield True, f'<tr class="diff_unmodified">{_cell(left_no, ln, "")}{_cell(right_no, ln, "")}</tr>'
+    yield from paired([])
+
+    yield False, _HTML_TAIL
 
-            buffer_block = []
-            unchanged_count = 0
-            new_rows.append(row)
 
-    return "\n".join(new_rows)
+def slurp(path):
+    """Read a whole file as bytes with a single read of its stat size."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        chunks = [os.read(fd, size)]
+        # short reads (pipes, /proc, files growing underneath us)
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+    return b"".join(chunks) if len(chunks) > 1 else chunks[0]
+
+
+# Below this size a thread costs more than it saves
+_CONCURRENT_READ_MIN = 64 * 1024
+
+
+def slurp_pair(path_a, path_b):
+    """Read two files, overlapping the reads when either one is large."""
+    try:
+        big = max(os.stat(path_a).st_size, os.stat(path_b).st_size) >= _CONCURRENT_READ_MIN
+    except OSError:
+        big = False  # let slurp raise the real error
+
+    if not big:
+        return slurp(path_a), slurp(path_b)
+
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        fut_a = ex.submit(slurp, path_a)
+        fut_b = ex.submit(slurp, path_b)
+        return fut_a.result(), fut_b.result()
 
 
 def generate_html_diff(current_file,
@@ -149,28 +362,28 @@ def generate_html_diff(current_file,
                        output_html,
                        device_name="Device"):
 
-    with open(current_file, "r", encoding="utf-8") as f:
-        xml_before = f.read()
-
-    with open(candidate_file, "r", encoding="utf-8") as f:
-        xml_after = f.read()
+    # raw bytes: lxml honours the XML encoding declaration itself
+    xml_before, xml_after = slurp_pair(current_file, candidate_file)
 
-    left_lines, right_lines = build_visual_model(xml_before, xml_after)
+    if xml_before == xml_after:
+        # byte-identical: xmldiff would find nothing, only the baseline shows
+        left_lines = right_lines = pretty_lines(xml_before)
+    else:
+        left_lines, right_lines = build_visual_model(xml_before, xml_after)
 
-    diff_html = difflib.HtmlDiff(
-        tabsize=4,
-        wrapcolumn=120
-    ).make_file(
+    rows = collapse_rows(iter_html_diff_rows(
         left_lines,
         right_lines,
         fromdesc=f"Current Configuration ({device_name})",
         todesc=f"Candidate Configuration ({device_name})"
-    )
-
-    diff_html = add_collapsible_sections(diff_html)
-
-    with open(output_html, "w", encoding="utf-8") as f:
-        f.write(diff_html)
+    ))
+
+    # stream rows out as they are produced; never hold the whole page
+    with open(output_html, "w", encoding="utf-8", buffering=1 << 20) as f:
+        f.write(next(rows))
+        for row in rows:
+            f.write("\n")
+            f.write(row)
 
     print(f"✔ Combined diff written to: {output_html}")
 
@@ -12,10 +12,14 @@ Usage example:
 """
 
 from lxml import etree
-from xmldiff import main, formatting
-import difflib
+from xmldiff import main, actions
+from xmldiff.utils import getpath
+from html import escape
 import argparse
-from typing import List, Tuple
+import re
+from functools import lru_cache
+from itertools import chain, islice, repeat, zip_longest
+from typing import Iterable, List, Tuple
 
 
 # ================================================================
@@ -33,249 +37,451 @@ def qname_local(tag):
     return tag
 
 
+@lru_cache(maxsize=1024)
+def compiled_xpath(path: str) -> etree.XPath:
+    """Compiled XPath per expression, shared across builds."""
+    return etree.XPath(path)
+
+
+_STEP_RE = re.compile(r"([A-Za-z_][\w.\-]*)(?:\[(\d+)\])?$")
+
+
+def resolve_path(root: etree._Element, path: str, fallback) -> List[etree._Element]:
+    """
+    Resolve a simple absolute step chain (/root/foo[3]/bar) by walking
+    children directly; anything else (//, @, *, functions, prefixes) is
+    passed to the fallback XPath callable.
+    """
+    steps = path.split("/")
+    if steps[0] or "//" in path:
+        return fallback(path)
+
+    matches = []
+    for step in steps[1:]:
+        m = _STEP_RE.match(step)
+        if not m:
+            return fallback(path)
+        matches.append((m.group(1), int(m.group(2)) if m.group(2) else None))
+
+    tag, idx = matches[0]
+    doc_root = root.getroottree().getroot()
+    current = [doc_root] if doc_root.tag == tag and idx in (None, 1) else []
+
+    for tag, idx in matches[1:]:
+        found = []
+        for parent in current:
+            if idx is None:
+                found.extend(parent.iterchildren(tag))
+            else:
+                for pos, child in enumerate(parent.iterchildren(tag), 1):
+                    if pos == idx:
+                        found.append(child)
+                        break
+        current = found
+    return current
+
+
 def pretty_lines_of_element(elem: etree._Element) -> List[str]:
     s = etree.tostring(elem, pretty_print=True, encoding="unicode")
     return s.splitlines()
 
 
+_INDENTS = ["  " * d for d in range(64)]
+
+
+def indent_for(depth: int) -> str:
+    return _INDENTS[depth] if depth < 64 else "  " * depth
+
+
 def open_tag_line(elem: etree._Element, depth: int) -> str:
     tag = qname_local(elem.tag)
     attrs = " ".join(f'{k}="{v}"' for k, v in elem.attrib.items())
     if attrs:
-        return ("  " * depth) + f"<{tag} {attrs}>"
+        return indent_for(depth) + f"<{tag} {attrs}>"
     else:
-        return ("  " * depth) + f"<{tag}>"
+        return indent_for(depth) + f"<{tag}>"
 
 
 def close_tag_line(elem: etree._Element, depth: int) -> str:
     tag = qname_local(elem.tag)
-    return ("  " * depth) + f"</{tag}>"
+    return indent_for(depth) + f"</{tag}>"
+
+
+def tag_lines(elem: etree._Element, depth: int,
+              tag_cache: dict = None) -> Tuple[str, str]:
+    """Open and close tag lines of elem, memoized per (elem, depth)."""
+    if tag_cache is None:
+        return open_tag_line(elem, depth), close_tag_line(elem, depth)
+    key = (elem, depth)
+    pair = tag_cache.get(key)
+    if pair is None:
+        pair = tag_cache[key] = (open_tag_line(elem, depth), close_tag_line(elem, depth))
+    return pair
 
 
 def minimal_wrapper_for(path_elems: List[etree._Element],
-                        inner_lines: List[str]) -> List[str]:
+                        inner_lines: List[str],
+                        tag_cache: dict = None) -> List[str]:
     """Wrap inner lines with their ancestor tag structure."""
-    lines = []
+    pairs = [tag_lines(anc, depth, tag_cache) for depth, anc in enumerate(path_elems)]
 
     # open ancestors
-    for depth, anc in enumerate(path_elems):
-        lines.append(open_tag_line(anc, depth))
+    lines = [open_line for open_line, _ in pairs]
 
     # indent inner content
-    indent = "  " * len(path_elems)
-    for ln in inner_lines:
-        lines.append(indent + ln)
+    indent = indent_for(len(path_elems))
+    lines.extend([indent + ln for ln in inner_lines])
 
     # close ancestors
-    for depth, anc in enumerate(reversed(path_elems)):
-        lines.append(close_tag_line(anc, len(path_elems) - depth - 1))
+    lines.extend(close_line for _, close_line in reversed(pairs))
 
     return lines
 
 
-def find_child_slice(parent: etree._Element,
-                     target: etree._Element,
-                     sibling_count: int):
-    """Return list of surrounding children including the target."""
-    children = [c for c in parent if isinstance(c.tag, str)]
-
-    # find index
-    idx = None
-    for i, c in enumerate(children):
-        if c is target:
-            idx = i
-            break
-        if etree.tostring(c) == etree.tostring(target):
-            idx = i
-            break
+def find_child_slice(target: etree._Element, sibling_count: int):
+    """
+    Return list of surrounding children including the target.
 
-    if idx is None:
+    The window is read off the target's own sibling links, so only
+    2 * sibling_count neighbours are visited regardless of parent size.
+    """
+    if not isinstance(target.tag, str):
         return [target]
 
-    lo = max(0, idx - sibling_count)
-    hi = min(len(children) - 1, idx + sibling_count)
-    return children[lo : hi + 1]
+    before = list(islice(target.itersiblings(etree.Element, preceding=True), sibling_count))
+    before.reverse()
+    return [*before, target, *islice(target.itersiblings(etree.Element), sibling_count)]
+
+
+def ancestors_of(parent: etree._Element,
+                 ancestor_cache: dict = None) -> List[etree._Element]:
+    """Return parent and its ancestors, outermost first."""
+    if ancestor_cache is not None and parent in ancestor_cache:
+        return ancestor_cache[parent]
+    ancestors = list(parent.iterancestors())
+    ancestors.reverse()
+    ancestors.append(parent)
+    if ancestor_cache is not None:
+        ancestor_cache[parent] = ancestors
+    return ancestors
 
 
 # ================================================================
 # Core diff block builder
 # ================================================================
 
+class ReplaceNode:
+    """Synthetic action: a delete and an insert of the same path."""
+
+
+class _BlockContext:
+    """Trees, evaluators and per-parent caches shared by the handlers."""
+
+    def __init__(self, root_before: etree._Element, root_after: etree._Element,
+                 sibling_count: int):
+        self.root_before = root_before
+        self.root_after = root_after
+        # non-trivial paths go through compiled XPath objects, so each
+        # expression is parsed once no matter how often it recurs
+        self.ev_before = lambda path: compiled_xpath(path)(root_before)
+        self.ev_after = lambda path: compiled_xpath(path)(root_after)
+        self.sibling_count = sibling_count
+        # per-parent caches shared by all actions touching the same ancestors
+        self.ancestor_cache = {}
+        self.tag_cache = {}
+        # overlapping sibling windows pretty-print each element only once
+        self.pretty_cache = {}
+
+    def before(self, path: str) -> List[etree._Element]:
+        return resolve_path(self.root_before, path, self.ev_before)
+
+    def after(self, path: str) -> List[etree._Element]:
+        return resolve_path(self.root_after, path, self.ev_after)
+
+    def slice_lines(self, target: etree._Element) -> List[str]:
+        inner = []
+        for c in find_child_slice(target, self.sibling_count):
+            lines = self.pretty_cache.get(c)
+            if lines is None:
+                lines = self.pretty_cache[c] = pretty_lines_of_element(c)
+            inner.extend(lines)
+        return inner
+
+
+def _action_path(action, ctx: _BlockContext) -> str:
+    """Path of the node an action is about (for inserts: the new child)."""
+    if isinstance(action, actions.InsertNode):
+        parents = ctx.after(action.target)
+        if parents and action.position < len(parents[0]):
+            child = parents[0][action.position]
+            if child.tag == action.tag:
+                return getpath(child)
+        return f"{action.target}/*[{action.position + 1}]"
+    return getattr(action, "node", "")  # namespace actions carry no node
+
+
+# ------------------------------------------------------------
+# DELETE
+# ------------------------------------------------------------
+def _handle_delete(ctx: _BlockContext, node_path: str, action):
+    nodes = ctx.before(node_path)
+    if not nodes:
+        return [f"<!-- deleted {node_path} -->"], [""]
+
+    target = nodes[0]
+    parent = target.getparent()
+    left_block = minimal_wrapper_for(ancestors_of(parent, ctx.ancestor_cache),
+                                     ctx.slice_lines(target),
+                                     ctx.tag_cache)
+    return left_block, repeat("", len(left_block))
+
+
+# ------------------------------------------------------------
+# INSERT
+# ------------------------------------------------------------
+def _handle_insert(ctx: _BlockContext, node_path: str, action):
+    nodes = ctx.after(node_path)
+    if not nodes:
+        return [""], [f"<!-- inserted {node_path} -->"]
+
+    target = nodes[0]
+    parent = target.getparent()
+    right_block = minimal_wrapper_for(ancestors_of(parent, ctx.ancestor_cache),
+                                      ctx.slice_lines(target),
+                                      ctx.tag_cache)
+    return repeat("", len(right_block)), right_block
+
+
+# ------------------------------------------------------------
+# UPDATE TEXT / UPDATE ATTRIB / REPLACE (delete + insert)
+# ------------------------------------------------------------
+def _handle_update(ctx: _BlockContext, node_path: str, action,
+                   after_path: str = None):
+    # find nodes on both trees
+    before_nodes = ctx.before(node_path)
+    after_nodes = ctx.after(after_path or node_path)
+
+    parent = None
+    if before_nodes:
+        parent = before_nodes[0].getparent()
+    elif after_nodes:
+        parent = after_nodes[0].getparent()
+
+    if parent is None:
+        old = getattr(action, "oldtext", getattr(action, "oldvalue", ""))
+        new = getattr(action, "text", getattr(action, "value", ""))
+        return [str(old)], [str(new)]
+
+    ancestors = ancestors_of(parent, ctx.ancestor_cache)
+    # each side's window comes from its own tree
+    inner_before = ctx.slice_lines(before_nodes[0]) if before_nodes else []
+    inner_after = ctx.slice_lines(after_nodes[0]) if after_nodes else []
+
+    left_block = minimal_wrapper_for(ancestors, inner_before or [""], ctx.tag_cache)
+    right_block = minimal_wrapper_for(ancestors, inner_after or [""], ctx.tag_cache)
+
+    # pad to equal length
+    if len(left_block) < len(right_block):
+        left_block.extend([""] * (len(right_block) - len(left_block)))
+    elif len(right_block) < len(left_block):
+        right_block.extend([""] * (len(left_block) - len(right_block)))
+    return left_block, right_block
+
+
+# ------------------------------------------------------------
+# RENAME: the after tree has the node under its new tag, at the same place
+# ------------------------------------------------------------
+def _handle_rename(ctx: _BlockContext, node_path: str, action):
+    before_nodes = ctx.before(node_path)
+    if before_nodes and before_nodes[0].getparent() is not None:
+        node = before_nodes[0]
+        parent = node.getparent()
+        after_path = f"{getpath(parent)}/*[{parent.index(node) + 1}]"
+        return _handle_update(ctx, node_path, action, after_path)
+    return _handle_update(ctx, node_path, action)
+
+
+# ------------------------------------------------------------
+# MOVE: old place on the left, new place on the right
+# ------------------------------------------------------------
+def _handle_move(ctx: _BlockContext, node_path: str, action):
+    left_block = list(_handle_delete(ctx, node_path, action)[0])
+    target_path = f"{action.target}/*[{action.position + 1}]"
+    right_block = list(_handle_insert(ctx, target_path, action)[1])
+
+    # pad to equal length
+    if len(left_block) < len(right_block):
+        left_block.extend([""] * (len(right_block) - len(left_block)))
+    elif len(right_block) < len(left_block):
+        right_block.extend([""] * (len(left_block) - len(right_block)))
+    return left_block, right_block
+
+
+HANDLERS = {
+    actions.DeleteNode: _handle_delete,
+    actions.InsertNode: _handle_insert,
+    actions.UpdateTextIn: _handle_update,
+    actions.UpdateTextAfter: _handle_update,
+    actions.UpdateAttrib: _handle_update,
+    actions.InsertAttrib: _handle_update,
+    actions.DeleteAttrib: _handle_update,
+    actions.RenameAttrib: _handle_update,
+    actions.RenameNode: _handle_rename,
+    actions.MoveNode: _handle_move,
+    ReplaceNode: _handle_update,
+}
+
+
 def build_context_blocks(xml_before: str,
                          xml_after: str,
-                         sibling_count: int = 0) -> List[Tuple[List[str], List[str]]]:
-
-    # XmlDiffFormatter → list of Action objects
-    diff_actions = main.diff_texts(
-        xml_before,
-        xml_after,
-        formatter=formatting.XmlDiffFormatter()
-    )
+                         sibling_count: int = 0) -> List[Tuple[Iterable[str], Iterable[str]]]:
+    """
+    One (left, right) pair of line sequences per change. The blank side of
+    a pure delete or insert is a lazy itertools.repeat, so blocks are meant
+    to be consumed once, as render_blocks_to_html does.
+    """
 
-    root_before = etree.fromstring(xml_before)
-    root_after = etree.fromstring(xml_after)
+    # parse once; xmldiff works on the same trees we look paths up in
+    parser = etree.XMLParser(remove_blank_text=True, collect_ids=False)
+    root_before = etree.fromstring(xml_before, parser)
+    root_after = etree.fromstring(xml_after, parser)
+
+    # no formatter → raw action namedtuples, dispatched on their class
+    diff_actions = main.diff_trees(root_before, root_after)
+
+    ctx = _BlockContext(root_before, root_after, sibling_count)
+
+    # Deduplicate up front: the last action per (type, path) wins, and a
+    # delete + insert of the same path collapses into a single replace
+    # Exact repeats are dropped on the raw namedtuple first, so no path is
+    # resolved for them; the class is part of the key because actions with
+    # the same fields compare equal as plain tuples
+    actions_by_key = {}
+    for kind, action in dict.fromkeys((type(a), a) for a in diff_actions):
+        actions_by_key[(kind, _action_path(action, ctx))] = action
+
+    merged = {}
+    for (kind, node_path), action in actions_by_key.items():
+        if kind in (actions.DeleteNode, actions.InsertNode) and \
+                (actions.DeleteNode, node_path) in actions_by_key and \
+                (actions.InsertNode, node_path) in actions_by_key:
+            merged[(ReplaceNode, node_path)] = action
+        else:
+            merged[(kind, node_path)] = action
 
     blocks = []
-    seen = set()
-
-    for action in diff_actions:
-        action_type = type(action).__name__  # e.g. InsertNode, DeleteNode, UpdateText
-        node_path = action.node              # xpath string
-
-        key = (action_type, node_path)
-        if key in seen:
-            continue
-        seen.add(key)
-
-        left_block = []
-        right_block = []
-
-        # ------------------------------------------------------------
-        # DELETE
-        # ------------------------------------------------------------
-        if action_type == "DeleteNode":
-            nodes = root_before.xpath(node_path)
-            if nodes:
-                target = nodes[0]
-                parent = target.getparent()
-                ancestors = []
-                a = parent
-                while a is not None:
-                    ancestors.insert(0, a)
-                    a = a.getparent()
-
-                slice_children = find_child_slice(parent, target, sibling_count)
-                inner = []
-                for c in slice_children:
-                    inner.extend(pretty_lines_of_element(c))
-
-                left_block = minimal_wrapper_for(ancestors, inner)
-                right_block = [""] * len(left_block)
-
-            else:
-                left_block = [f"<!-- deleted {node_path} -->"]
-                right_block = [""]
-
-        # ------------------------------------------------------------
-        # INSERT
-        # ------------------------------------------------------------
-        elif action_type == "InsertNode":
-            nodes = root_after.xpath(node_path)
-            if nodes:
-                target = nodes[0]
-                parent = target.getparent()
-                ancestors = []
-                a = parent
-                while a is not None:
-                    ancestors.insert(0, a)
-                    a = a.getparent()
-
-                slice_children = find_child_slice(parent, target, sibling_count)
-                inner = []
-                for c in slice_children:
-                    inner.extend(pretty_lines_of_element(c))
-
-                right_block = minimal_wrapper_for(ancestors, inner)
-                left_block = [""] * len(right_block)
-
-            else:
-                left_block = [""]
-                right_block = [f"<!-- inserted {node_path} -->"]
-
-        # ------------------------------------------------------------
-        # UPDATE TEXT / UPDATE ATTRIB
-        # ------------------------------------------------------------
-        elif action_type in ("UpdateText", "UpdateAttrib"):
-
-            # find nodes on both trees
-            before_nodes = root_before.xpath(node_path)
-            after_nodes = root_after.xpath(node_path)
-
-            parent = None
-            if before_nodes:
-                parent = before_nodes[0].getparent()
-            elif after_nodes:
-                parent = after_nodes[0].getparent()
-
-            if not parent:
-                left_block = [str(getattr(action, "old", ""))]
-                right_block = [str(getattr(action, "new", ""))]
-            else:
-                ancestors = []
-                a = parent
-                while a is not None:
-                    ancestors.insert(0, a)
-                    a = a.getparent()
-
-                # before side
-                inner_before = []
-                if before_nodes:
-                    target_b = before_nodes[0]
-                    slice_b = find_child_slice(parent, target_b, sibling_count)
-                    for c in slice_b:
-                        inner_before.extend(pretty_lines_of_element(c))
-
-                # after side
-                inner_after = []
-                if after_nodes:
-                    target_a = after_nodes[0]
-                    slice_a = find_child_slice(parent, target_a, sibling_count)
-                    for c in slice_a:
-                        inner_after.extend(pretty_lines_of_element(c))
-
-                left_block = minimal_wrapper_for(ancestors, inner_before or [""])
-                right_block = minimal_wrapper_for(ancestors, inner_after or [""])
-
-                # pad to equal length
-                if len(left_block) < len(right_block):
-                    left_block.extend([""] * (len(right_block) - len(left_block)))
-                elif len(right_block) < len(left_block):
-                    right_block.extend([""] * (len(left_block) - len(right_block)))
-
-        # ------------------------------------------------------------
-        # UNKNOWN ACTION
-        # ------------------------------------------------------------
+    for (kind, node_path), action in merged.items():
+        handler = HANDLERS.get(kind)
+        if handler:
+            blocks.append(handler(ctx, node_path, action))
         else:
-            left_block = [f"<!-- unhandled action {action_type} -->"]
-            right_block = [""]
-
-        blocks.append((left_block, right_block))
+            blocks.append(([f"<!-- unhandled action {kind.__name__} -->"], [""]))
 
     return blocks
 
 
 # ================================================================
-# Rendering to HtmlDiff
+# Rendering (HtmlDiff look-alike)
 # ================================================================
 
-def render_blocks_to_html(blocks: List[Tuple[List[str], List[str]]],
+# Blocks arrive already aligned row for row (the blank side is padded with
+# ""), so there is nothing left for difflib's line matcher to do; rows are
+# written straight into a table styled like difflib.HtmlDiff output.
+_HTML_HEAD = """<!DOCTYPE html>
+<html>
+<head>
+<meta http-equiv="Content-Type" content="text/html; charset=utf-8" />
+<title></title>
+<style type="text/css">
+    table.diff {font-family:Courier; border:medium;}
+    .diff_header {background-color:#e0e0e0}
+    td.diff_header {text-align:right}
+    td.diff_text {white-space:pre-wrap; word-break:break-all; max-width:120ch}
+    .diff_next {background-color:#c0c0c0}
+    .diff_add {background-color:#aaffaa}
+    .diff_chg {background-color:#ffff77}
+    .diff_sub {background-color:#ffaaaa}
+</style>
+</head>
+<body>
+<table class="diff" cellspacing="0" cellpadding="0" rules="groups">
+<colgroup></colgroup> <colgroup></colgroup> <colgroup></colgroup>
+<colgroup></colgroup> <colgroup></colgroup> <colgroup></colgroup>
+<thead><tr><th class="diff_next"><br /></th><th colspan="2" class="diff_header">{fromdesc}</th><th class="diff_next"><br /></th><th colspan="2" class="diff_header">{todesc}</th></tr></thead>
+<tbody>
+"""
+
+_HTML_TAIL = """</tbody>
+</table>
+<table class="diff" summary="Legends">
+<tr> <th colspan="2"> Legends </th> </tr>
+<tr> <td> <table border="" summary="Colors">
+<tr><th> Colors </th> </tr>
+<tr><td class="diff_add">&nbsp;Added&nbsp;</td></tr>
+<tr><td class="diff_chg">Changed</td> </tr>
+<tr><td class="diff_sub">Deleted</td> </tr>
+</table></td> </tr>
+</table>
+</body>
+</html>
+"""
+
+_ROW = ('<tr><td class="diff_next"></td><td class="diff_header">{}</td>'
+        '<td class="diff_text{}">{}</td><td class="diff_next"></td>'
+        '<td class="diff_header">{}</td><td class="diff_text{}">{}</td></tr>\n')
+
+
+def iter_table_rows(left_lines: Iterable[str],
+                    right_lines: Iterable[str]) -> Iterable[str]:
+    """
+    One <tr> per aligned row. A row with text on one side only is an add
+    or a delete, text on both sides that differs is a change; blank
+    padding gets no line number.
+    """
+    left_no = right_no = 0
+    for left, right in zip_longest(left_lines, right_lines, fillvalue=""):
+        if left == right:
+            left_cls = right_cls = ""
+        elif not left:
+            left_cls, right_cls = "", " diff_add"
+        elif not right:
+            left_cls, right_cls = " diff_sub", ""
+        else:
+            left_cls = right_cls = " diff_chg"
+        if left:
+            left_no += 1
+        if right:
+            right_no += 1
+        yield _ROW.format(left_no if left else "", left_cls, escape(left),
+                          right_no if right else "", right_cls, escape(right))
+
+
+def render_blocks_to_html(blocks: List[Tuple[Iterable[str], Iterable[str]]],
                           output_html: str,
                           device_name: str):
 
-    left_lines = []
-    right_lines = []
-    sep = ["..."]
+    sep = ("...",)
 
-    for i, (lb, rb) in enumerate(blocks):
-        if i > 0:
-            left_lines.extend(sep)
-            right_lines.extend(sep)
-        left_lines.extend(lb)
-        right_lines.extend(rb)
+    def side(idx: int) -> Iterable[str]:
+        # one flat stream per column, "..." between blocks; nothing is
+        # concatenated up front
+        return chain.from_iterable(
+            chain(sep, block[idx]) if i else block[idx]
+            for i, block in enumerate(blocks)
+        )
 
-    if not left_lines:
+    if blocks:
+        left_lines = side(0)
+        right_lines = side(1)
+    else:
         left_lines = ["<!-- no changes -->"]
         right_lines = ["<!-- no changes -->"]
 
-    diff_html = difflib.HtmlDiff(wrapcolumn=120).make_file(
-        left_lines,
-        right_lines,
-        fromdesc=f"Current Configuration ({device_name})",
-        todesc=f"Candidate Configuration ({device_name})",
-    )
-
-    with open(output_html, "w", encoding="utf-8") as f:
-        f.write(html)
+    with open(output_html, "w", encoding="utf-8", buffering=1 << 20) as f:
+        f.write(_HTML_HEAD.replace("{fromdesc}", escape(f"Current Configuration ({device_name})"))
+                          .replace("{todesc}", escape(f"Candidate Configuration ({device_name})")))
+        f.writelines(iter_table_rows(left_lines, right_lines))
+        f.write(_HTML_TAIL)
     print(f"✔ Written {output_html} (blocks={len(blocks)})")
 
 # --- PUBLIC API (for import) ----------------------------------------
@@ -5,10 +5,167 @@ from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
 from ansible.plugins.action import ActionBase
-import re
-import xml.etree.ElementTree as ET
+import io
+from functools import lru_cache
 import difflib
-from copy import deepcopy
+
+# lxml parses in C; the Element API used below is the same in both
+try:
+    from lxml import etree as ET
+    # Comments and PIs are dropped and internal entities expanded as
+    # ElementTree does (external ones never are), and the text is handed
+    # over as UTF-8 bytes so an encoding declaration in the document is
+    # ignored
+    _PARSE_OPTIONS = dict(
+        remove_blank_text=True,
+        remove_comments=True,
+        remove_pis=True,
+        resolve_entities='internal',
+        huge_tree=True,
+        encoding='utf-8',
+    )
+except ImportError:
+    import xml.etree.ElementTree as ET
+    _PARSE_OPTIONS = None
+
+# Yields every element at its end event: children always come before
+# their parent, so per-node work can be done while the tree is built
+def _iterparse(text):
+    if _PARSE_OPTIONS is None:
+        return ET.iterparse(io.StringIO(text), events=('end',))
+    return ET.iterparse(io.BytesIO(text.encode('utf-8')), events=('end',), **_PARSE_OPTIONS)
+
+# cdifflib's C implementation of SequenceMatcher is a drop-in replacement
+# and gives the same opcodes; fall back to difflib when it isn't installed
+try:
+    from cdifflib import CSequenceMatcher as _SequenceMatcher
+except ImportError:
+    _SequenceMatcher = difflib.SequenceMatcher
+
+_HTML_ESCAPE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
+# HTML escaping is pure and the same values (tag texts, VLAN ids, "true")
+# recur throughout a report, so both helpers are memoized
+@lru_cache(maxsize=8192)
+def _escape_html(s):
+    if not s: return ""
+    return s.translate(_HTML_ESCAPE)
+
+@lru_cache(maxsize=4096)
+def _escape_attr(value):
+    return _escape_html(value).replace('"', '&quot;')
+
+# Indent styles per nesting level, built once
+_INDENT_STYLES = ["padding-left: {}px;".format(i * 20) for i in range(64)]
+
+def _indent_style(level):
+    if level < len(_INDENT_STYLES):
+        return _INDENT_STYLES[level]
+    return "padding-left: {}px;".format(level * 20)
+
+# SequenceMatcher opcodes for two child-key lists. Most parents have zero
+# or one child, or identical children on both sides; those answers are
+# produced directly instead of building a matcher
+def _fast_opcodes(a, b):
+    if a == b:
+        return [('equal', 0, len(a), 0, len(b))] if a else []
+    if not a:
+        return [('insert', 0, 0, 0, len(b))]
+    if not b:
+        return [('delete', 0, len(a), 0, 0)]
+    if len(a) == 1 and len(b) == 1:
+        return [('replace', 0, 1, 0, 1)]
+    return _SequenceMatcher(None, a, b).get_opcodes()
+
+# Tags that should always be shown if their parent is modified
+_CONTEXT_TAGS = frozenset({'name', 'id', 'description', 'type', 'vlan-id'})
+
+_SPACER = '<div class="spacer">&nbsp;</div>'
+
+def _tag_html(node, tag_style):
+    attrs = "".join(
+        ' {}="{}"'.format(k, _escape_attr(v))
+        for k, v in node.attrib.items() if not k.startswith('__')
+    )
+    return ('<span style="{}">&lt;{}{}&gt;</span>'.format(tag_style, node.tag, attrs),
+            '<span style="{}">&lt;/{}&gt;</span>'.format(tag_style, node.tag))
+
+# Renders a source subtree as-is (context tags). Only the root's
+# text is normalized, as the copied context element had it
+def _render_plain(root, level, out):
+    stack = [(root, level, _escape_html((root.text or "").strip()))]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            out.append(item)
+            continue
+        node, level, text = item
+        indent_style = _indent_style(level)
+        start_tag_html, end_tag_html = _tag_html(node, "color: #6b7280;")
+
+        if len(node) == 0:
+            content_html = text or ""
+            if not content_html.startswith('<span'):
+                content_html = '<span style="color: #374151;">{}</span>'.format(content_html)
+            out.append('<div style="{}">{}{}{}</div>'.format(indent_style, start_tag_html, content_html, end_tag_html))
+            continue
+
+        out.append('<div style="{}">{}</div>'.format(indent_style, start_tag_html))
+        if text and text.strip():
+            text_content = text.strip()
+            if not text_content.startswith('<span'):
+                text_content = '<span style="color: #374151;">{}</span>'.format(text_content)
+            out.append('<div style="{}">{}</div>'.format(_indent_style(level + 1), text_content))
+        stack.append('<div style="{}">{}</div>'.format(indent_style, end_tag_html))
+        stack.extend((child, level + 1, child.text) for child in reversed(node))
+
+# Renders a removed/added subtree: every tag in the diff colour and
+# non-blank text wrapped in a bold span of the same colour
+def _render_marked(root, level, style, out):
+    stack = [(root, level)]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            out.append(item)
+            continue
+        node, level = item
+        indent_style = _indent_style(level)
+        start_tag_html, end_tag_html = _tag_html(node, style)
+
+        text = node.text
+        if text and text.strip():
+            text_html = '<span style="{} font-weight:bold;">{}</span>'.format(style, _escape_html(text))
+        else:
+            text_html = None
+
+        if len(node) == 0:
+            if text_html is None:
+                text_html = '<span style="color: #374151;">{}</span>'.format(text or "")
+            out.append('<div style="{}">{}{}{}</div>'.format(indent_style, start_tag_html, text_html, end_tag_html))
+            continue
+
+        out.append('<div style="{}">{}</div>'.format(indent_style, start_tag_html))
+        if text_html is not None:
+            out.append('<div style="{}">{}</div>'.format(_indent_style(level + 1), text_html))
+        stack.append('<div style="{}">{}</div>'.format(indent_style, end_tag_html))
+        stack.extend((child, level + 1) for child in reversed(node))
+
+# A same-tag pair whose children are still being compared: start_a and
+# start_b are the slots of its opening markup, pairs yields the child
+# pairs still to compare
+class _Frame(object):
+    __slots__ = ('node_a', 'node_b', 'level', 'start_a', 'start_b',
+                 'pairs', 'has_child_changes', 'has_child_output')
+
+    def __init__(self, node_a, node_b, level, start_a, start_b):
+        self.node_a = node_a
+        self.node_b = node_b
+        self.level = level
+        self.start_a = start_a
+        self.start_b = start_b
+        self.pairs = None
+        self.has_child_changes = False
+        self.has_child_output = False
 
 class ActionModule(ActionBase):
     def run(self, tmp=None, task_vars=None):
@@ -24,155 +181,165 @@ class ActionModule(ActionBase):
 
         # 2. Logic Implementation (Encapsulated)
         def compute_diff(before_str, after_str):
-            # Tags that should always be shown if their parent is modified
-            CONTEXT_TAGS = {'name', 'id', 'description', 'type', 'vlan-id'}
-
-            def escape_html(s):
-                if not s: return ""
-                return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-
-            node_keys = {}
+            # Everything the diff needs per node, in one record so each
+            # child costs a single lookup:
+            #   node -> (sort key, structural id, rendered height in lines)
+            # Structural ids are one small int per distinct subtree shape,
+            # shared by both documents, so matching compares ints instead of
+            # hashing and comparing nested key tuples at every level. Spacers
+            # for added/removed subtrees are sized from the height.
+            node_meta = {}
+            shape_ids = {}
 
+            # Key, id and height for one node whose children have all been
+            # handled already; parse_clean calls it in post-order
             def sort_and_key(node):
-                child_keys = []
-                for child in node:
-                    child_keys.append(sort_and_key(child))
-                
-                if child_keys:
-                    children_with_keys = sorted(zip(node, child_keys), key=lambda x: x[1])
-                    node[:] = [x[0] for x in children_with_keys]
-                    my_sorted_child_keys = tuple(x[1] for x in children_with_keys)
-                else:
-                    my_sorted_child_keys = ()
+                # Namespaces are ignored: compare on local names only
+                if node.tag[0] == '{':
+                    node.tag = node.tag.split('}', 1)[1]
+                attrib = node.attrib
+                for name in [k for k in attrib.keys() if k[0] == '{']:
+                    attrib[name.split('}', 1)[1]] = attrib.pop(name)
+
+                children = list(node)
+                metas = [node_meta[c] for c in children]
+                n = len(children)
+                if n > 1:
+                    # The full keys still decide the order, so similar
+                    # siblings stay next to each other on both sides.
+                    # Sort an index permutation rather than (child, key)
+                    # pairs, then apply it to the materialized child list
+                    child_keys = [m[0] for m in metas]
+                    perm = sorted(range(n), key=child_keys.__getitem__)
+                    node[:] = [children[i] for i in perm]
+                    metas = [metas[i] for i in perm]
 
+                attrs = tuple(sorted(node.attrib.items()))
+                text = (node.text or "").strip()
                 my_key = (
                     node.tag, 
-                    tuple(sorted(node.attrib.items())), 
-                    (node.text or "").strip(),
-                    my_sorted_child_keys
+                    attrs, 
+                    text,
+                    tuple(m[0] for m in metas)
                 )
-                node_keys[node] = my_key
+                # Children are already numbered, so the shape is only as
+                # wide as the node itself
+                shape = (node.tag, attrs, text, tuple(m[1] for m in metas))
+                node_id = shape_ids.setdefault(shape, len(shape_ids))
+
+                # A leaf renders inline on 1 line; a container takes open +
+                # close tags, a text line, plus its children's heights
+                if n:
+                    lines = (3 if text else 2) + sum(m[2] for m in metas)
+                else:
+                    lines = 1
+                node_meta[node] = (my_key, node_id, lines)
                 return my_key
 
+            # Parse, strip namespaces, sort and key in a single pass: the
+            # end events arrive bottom-up, the last one being the root
             def parse_clean(xml_str):
                 if not xml_str or not xml_str.strip():
                     return None
-                # Basic namespace stripping
-                clean_xml = re.sub(r' xmlns="[^"]+"', '', xml_str, count=0)
-                clean_xml = re.sub(r' xmlns:[a-z0-9]+="[^"]+"', '', clean_xml, count=0)
+                root = None
                 try:
-                    root = ET.fromstring(clean_xml)
-                    sort_and_key(root)
-                    return root
+                    for _, node in _iterparse(xml_str):
+                        sort_and_key(node)
+                        root = node
                 except ET.ParseError:
                     return None
+                return root
 
             root_before = parse_clean(before_str)
             root_after = parse_clean(after_str)
 
             stats = {"added": 0, "removed": 0, "modified": 0}
 
-            def count_lines(elem, is_leaf=False):
-                if elem is None: return 0
-                if is_leaf: return 1 
-                lines = 2 
-                if elem.text and elem.text.strip():
-                    lines += 1
-                for child in elem:
-                    child_is_leaf = (len(child) == 0)
-                    lines += count_lines(child, child_is_leaf)
-                return lines
-
-            def mark_tree(element, style):
-                if element is None: return
-                if element.text and element.text.strip():
-                    element.text = '<span style="{} font-weight:bold;">{}</span>'.format(style, escape_html(element.text))
-                element.set('__diff_style__', style)
-                for child in element:
-                    mark_tree(child, style)
+            # The diff is rendered straight into one list of HTML fragments
+            # per side while compare_nodes walks the trees; there is no
+            # intermediate output tree and spacers are plain strings
+            left = []
+            right = []
 
-            def compare_nodes(node_a, node_b):
+            # Compares one pair of nodes at the given indent level as far as
+            # possible without their children. Settled pairs are appended to
+            # both sides at once and report whether they changed; a same-tag
+            # pair gets a slot for its opening markup on each side and comes
+            # back as a _Frame, which compare_nodes completes with
+            # finish_pair once its children are done
+            def start_pair(node_a, node_b, level):
                 if node_a is None and node_b is None:
-                    return (None, None, False)
+                    return False
 
                 # Node Removed
                 if node_b is None:
                     stats["removed"] += 1
-                    res_a = deepcopy(node_a)
-                    mark_tree(res_a, "color:#cc0000;")
-                    lines = count_lines(res_a, len(res_a) == 0)
-                    res_b_spacer = ET.Element("__spacer__", lines=str(lines))
-                    return (res_a, res_b_spacer, True)
+                    _render_marked(node_a, level, "color:#cc0000;", left)
+                    right.append(_SPACER * node_meta[node_a][2])
+                    return True
 
                 # Node Added
                 if node_a is None:
                     stats["added"] += 1
-                    res_b = deepcopy(node_b)
-                    mark_tree(res_b, "color:#00aa00;")
-                    lines = count_lines(res_b, len(res_b) == 0)
-                    res_a_spacer = ET.Element("__spacer__", lines=str(lines))
-                    return (res_a_spacer, res_b, True)
+                    left.append(_SPACER * node_meta[node_b][2])
+                    _render_marked(node_b, level, "color:#00aa00;", right)
+                    return True
+
+                # Identical subtrees have nothing to report; skip the descent
+                if node_meta[node_a][1] == node_meta[node_b][1]:
+                    return False
 
                 # Tag Mismatch (Structural Difference)
                 if node_a.tag != node_b.tag:
                     stats["removed"] += 1
                     stats["added"] += 1
-                    res_a = deepcopy(node_a)
-                    res_b = deepcopy(node_b)
-                    mark_tree(res_a, "color:#cc0000;")
-                    mark_tree(res_b, "color:#00aa00;")
-                    
-                    lines_a = count_lines(res_a, len(res_a)==0)
-                    lines_b = count_lines(res_b, len(res_b)==0)
-                    
+                    _render_marked(node_a, level, "color:#cc0000;", left)
+                    _render_marked(node_b, level, "color:#00aa00;", right)
+
+                    # Pad the shorter side so both columns stay aligned
+                    lines_a = node_meta[node_a][2]
+                    lines_b = node_meta[node_b][2]
                     if lines_a < lines_b:
-                        res_a.set('__append_spacer__', str(lines_b - lines_a))
+                        left.append(_SPACER * (lines_b - lines_a))
                     elif lines_b < lines_a:
-                        res_b.set('__append_spacer__', str(lines_a - lines_b))
+                        right.append(_SPACER * (lines_a - lines_b))
                         
-                    return (res_a, res_b, True)
+                    return True
 
-                # Attributes & Text
-                text_a = (node_a.text or "").strip()
-                text_b = (node_b.text or "").strip()
-                is_modified = text_a != text_b
-                
-                if node_a.attrib != node_b.attrib:
-                    is_modified = True
+                # Reserve a slot for each side's opening markup: whether this
+                # node renders inline or as a container depends on whether
+                # anything is emitted for its children
+                frame = _Frame(node_a, node_b, level, len(left), len(right))
+                left.append(None)
+                right.append(None)
+                frame.pairs = child_pairs(frame)
+                return frame
 
-                out_a = ET.Element(node_a.tag, attrib=node_a.attrib)
-                out_b = ET.Element(node_b.tag, attrib=node_b.attrib)
-                
-                children_a = list(node_a)
-                children_b = list(node_b)
+            # Yields the child pairs of a frame to compare, in output order.
+            # Context tags are written out here, as the generator reaches them
+            def child_pairs(frame):
+                children_a = list(frame.node_a)
+                children_b = list(frame.node_b)
                 
-                keys_a = [node_keys.get(c) for c in children_a]
-                keys_b = [node_keys.get(c) for c in children_b]
+                keys_a = [node_meta[c][1] for c in children_a]
+                keys_b = [node_meta[c][1] for c in children_b]
 
-                matcher = difflib.SequenceMatcher(None, keys_a, keys_b)
-                has_child_changes = False
+                child_level = frame.level + 1
 
-                for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                for tag, i1, i2, j1, j2 in _fast_opcodes(keys_a, keys_b):
                     if tag == 'equal':
                         for k in range(i2 - i1):
                             c_a = children_a[i1 + k]
                             c_b = children_b[j1 + k]
                             
                             # Preserve Context Tags
-                            if c_a.tag in CONTEXT_TAGS:
-                                res_ctxt_a = deepcopy(c_a)
-                                res_ctxt_b = deepcopy(c_b)
-                                res_ctxt_a.text = escape_html((c_a.text or "").strip())
-                                res_ctxt_b.text = escape_html((c_b.text or "").strip())
+                            if c_a.tag in _CONTEXT_TAGS:
                                 # No visual style mark, just append
-                                out_a.append(res_ctxt_a)
-                                out_b.append(res_ctxt_b)
+                                _render_plain(c_a, child_level, left)
+                                _render_plain(c_b, child_level, right)
+                                frame.has_child_output = True
                             else:
-                                child_res_a, child_res_b, changed = compare_nodes(c_a, c_b)
-                                if changed:
-                                    has_child_changes = True
-                                    out_a.append(child_res_a)
-                                    out_b.append(child_res_b)
+                                yield c_a, c_b
                                 
                     elif tag == 'replace':
                         len_a = i2 - i1
@@ -184,115 +351,106 @@ class ActionModule(ActionBase):
                             c_b = children_b[j1 + k]
                             
                             if c_a.tag == c_b.tag:
-                                child_res_a, child_res_b, changed = compare_nodes(c_a, c_b)
-                                if changed:
-                                    has_child_changes = True
-                                    out_a.append(child_res_a)
-                                    out_b.append(child_res_b)
+                                yield c_a, c_b
                             else:
-                                res_a, res_b_spacer, _ = compare_nodes(c_a, None)
-                                res_a_spacer, res_b, _ = compare_nodes(None, c_b)
-                                has_child_changes = True
-                                out_a.append(res_a)
-                                out_b.append(res_b_spacer)
-                                out_a.append(res_a_spacer)
-                                out_b.append(res_b)
+                                yield c_a, None
+                                yield None, c_b
                         
                         if len_a > len_b:
                             for k in range(min_len, len_a):
-                                c_a = children_a[i1 + k]
-                                res_a, res_b_spacer, _ = compare_nodes(c_a, None)
-                                has_child_changes = True
-                                out_a.append(res_a)
-                                out_b.append(res_b_spacer)
+                                yield children_a[i1 + k], None
                         elif len_b > len_a:
                             for k in range(min_len, len_b):
-                                c_b = children_b[j1 + k]
-                                res_a_spacer, res_b, _ = compare_nodes(None, c_b)
-                                has_child_changes = True
-                                out_a.append(res_a_spacer)
-                                out_b.append(res_b)
+                                yield None, children_b[j1 + k]
                     
                     elif tag == 'delete':
                         for k in range(i1, i2):
-                            c_a = children_a[k]
-                            res_a, res_b_spacer, _ = compare_nodes(c_a, None)
-                            has_child_changes = True
-                            out_a.append(res_a)
-                            out_b.append(res_b_spacer)
+                            yield children_a[k], None
                     
                     elif tag == 'insert':
                         for k in range(j1, j2):
-                            c_b = children_b[k]
-                            res_a_spacer, res_b, _ = compare_nodes(None, c_b)
-                            has_child_changes = True
-                            out_a.append(res_a_spacer)
-                            out_b.append(res_b)
+                            yield None, children_b[k]
 
-                if is_modified:
-                    stats["modified"] += 1
-                    out_a.text = '<span style="color:#ff8800; font-weight:bold;">{}</span>'.format(escape_html(text_a))
-                    out_b.text = '<span style="color:#ff8800; font-weight:bold;">{}</span>'.format(escape_html(text_b))
-                    out_a.set('__diff_style__', 'color:#ff8800;') 
-                    out_b.set('__diff_style__', 'color:#ff8800;')
-                else:
-                    out_a.text = escape_html(text_a)
-                    out_b.text = escape_html(text_b)
+            # Fills in a frame's slots once its children are compared and
+            # reports whether anything changed below it
+            def finish_pair(frame):
+                node_a = frame.node_a
+                node_b = frame.node_b
+                level = frame.level
+                start_a = frame.start_a
+                start_b = frame.start_b
+                has_child_changes = frame.has_child_changes
+
+                # Attributes & Text
+                text_a = (node_a.text or "").strip()
+                text_b = (node_b.text or "").strip()
+                is_modified = text_a != text_b
                 
+                if node_a.attrib != node_b.attrib:
+                    is_modified = True
+
                 if not is_modified and not has_child_changes:
-                    return (None, None, False)
-                    
-                return (out_a, out_b, True)
+                    # Pruned: drop the slot and any context tags emitted
+                    del left[start_a:]
+                    del right[start_b:]
+                    return False
 
-            result_left, result_right, any_change = compare_nodes(root_before, root_after)
+                if is_modified:
+                    stats["modified"] += 1
 
-            def serialize(elem, level=0):
-                if elem is None: return ""
-                if elem.tag == "__spacer__":
-                    lines = int(elem.get('lines', 1))
-                    return "".join(['<div class="spacer">&nbsp;</div>' for _ in range(lines)])
+                has_child_output = frame.has_child_output or has_child_changes
+                indent_style = _indent_style(level)
+                for out, start, node, text in ((left, start_a, node_a, text_a), (right, start_b, node_b, text_b)):
+                    if is_modified:
+                        start_tag_html, end_tag_html = _tag_html(node, 'color:#ff8800;')
+                        text_html = '<span style="color:#ff8800; font-weight:bold;">{}</span>'.format(_escape_html(text))
+                    else:
+                        start_tag_html, end_tag_html = _tag_html(node, "color: #6b7280;")
+                        text_html = _escape_html(text)
+                        if text_html or not has_child_output:
+                            text_html = '<span style="color: #374151;">{}</span>'.format(text_html)
 
-                indent_style = "padding-left: {}px;".format(level * 20)
-                
-                attrs = ""
-                for k, v in elem.attrib.items():
-                    if not k.startswith('__'):
-                        val = escape_html(v).replace('"', '&quot;')
-                        attrs += ' {}="{}"'.format(k, val)
-                
-                tag_style = elem.get('__diff_style__') or "color: #6b7280;"
-                
-                start_tag_html = '<span style="{}">&lt;{}{}&gt;</span>'.format(tag_style, elem.tag, attrs)
-                end_tag_html = '<span style="{}">&lt;/{}&gt;</span>'.format(tag_style, elem.tag)
-                
-                append_spacer = int(elem.get('__append_spacer__', 0))
-                spacer_html = "".join(['<div class="spacer">&nbsp;</div>' for _ in range(append_spacer)])
-
-                if len(elem) == 0:
-                    content_html = elem.text or ""
-                    if not content_html.startswith('<span'):
-                        content_html = '<span style="color: #374151;">{}</span>'.format(content_html)
-                    return '<div style="{}">{}{}{}</div>{}'.format(indent_style, start_tag_html, content_html, end_tag_html, spacer_html)
-                
-                out = '<div style="{}">{}</div>'.format(indent_style, start_tag_html)
-                
-                if elem.text and elem.text.strip():
-                    text_indent = "padding-left: {}px;".format((level * 20) + 20)
-                    text_content = elem.text.strip()
-                    if not text_content.startswith('<span'):
-                        text_content = '<span style="color: #374151;">{}</span>'.format(text_content)
-                    out += '<div style="{}">{}</div>'.format(text_indent, text_content)
-                    
-                for child in elem:
-                    out += serialize(child, level + 1)
+                    if not has_child_output:
+                        out[start] = '<div style="{}">{}{}{}</div>'.format(indent_style, start_tag_html, text_html, end_tag_html)
+                        continue
+
+                    opening = '<div style="{}">{}</div>'.format(indent_style, start_tag_html)
+                    if text_html:
+                        opening += '<div style="{}">{}</div>'.format(_indent_style(level + 1), text_html)
+                    out[start] = opening
+                    out.append('<div style="{}">{}</div>'.format(indent_style, end_tag_html))
                     
-                out += '<div style="{}">{}</div>'.format(indent_style, end_tag_html)
-                out += spacer_html
-                return out
+                return True
+
+            # Appends both sides of the diff for two trees and reports whether
+            # they differ. Open frames live on an explicit stack, so deep
+            # documents don't run into the recursion limit
+            def compare_nodes(node_a, node_b):
+                stack = []
+                res = start_pair(node_a, node_b, 0)
+                while True:
+                    if type(res) is _Frame:
+                        stack.append(res)
+                    elif not stack:
+                        return res
+                    elif res:
+                        stack[-1].has_child_changes = True
+
+                    frame = stack[-1]
+                    pair = next(frame.pairs, None)
+                    if pair is None:
+                        stack.pop()
+                        res = finish_pair(frame)
+                    else:
+                        res = start_pair(pair[0], pair[1], frame.level + 1)
+
+            any_change = compare_nodes(root_before, root_after)
+            left_out = "".join(left)
+            right_out = "".join(right)
 
             return {
-                "left": serialize(result_left) or '<div class="text-gray-400 italic p-4">No Changes</div>',
-                "right": serialize(result_right) or '<div class="text-gray-400 italic p-4">No Changes</div>',
+                "left": left_out or '<div class="text-gray-400 italic p-4">No Changes</div>',
+                "right": right_out or '<div class="text-gray-400 italic p-4">No Changes</div>',
                 "metadata": {
                     "changed": any_change,
                     "added_count": stats["added"],
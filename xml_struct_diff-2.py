@@ -4,9 +4,78 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
-import re
-import xml.etree.ElementTree as ET
-from copy import deepcopy
+import io
+from functools import lru_cache
+from collections import namedtuple
+import difflib
+
+# lxml parses in C; the Element API used below is the same in both
+try:
+    from lxml import etree as ET
+    # Comments and PIs are dropped and internal entities expanded as
+    # ElementTree does (external ones never are), and the text is handed
+    # over as UTF-8 bytes so an encoding declaration in the document is
+    # ignored
+    _PARSE_OPTIONS = dict(
+        remove_blank_text=True,
+        remove_comments=True,
+        remove_pis=True,
+        resolve_entities='internal',
+        huge_tree=True,
+        encoding='utf-8',
+    )
+except ImportError:
+    import xml.etree.ElementTree as ET
+    _PARSE_OPTIONS = None
+
+# Yields every element at its end event: children always come before
+# their parent, so per-node work can be done while the tree is built
+def _iterparse(text):
+    if _PARSE_OPTIONS is None:
+        return ET.iterparse(io.StringIO(text), events=('end',))
+    return ET.iterparse(io.BytesIO(text.encode('utf-8')), events=('end',), **_PARSE_OPTIONS)
+
+# cdifflib's C implementation of SequenceMatcher is a drop-in replacement
+# and gives the same opcodes; fall back to difflib when it isn't installed
+try:
+    from cdifflib import CSequenceMatcher as _SequenceMatcher
+except ImportError:
+    _SequenceMatcher = difflib.SequenceMatcher
+
+_HTML_ESCAPE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
+# Helper for HTML escaping to ensure tags are visible in the report.
+# Pure, and the same tag texts recur throughout a report, so memoized
+@lru_cache(maxsize=8192)
+def _escape_html(s):
+    if not s: return ""
+    return s.translate(_HTML_ESCAPE)
+
+# Indent strings per nesting level, built once
+_INDENTS = ["  " * i for i in range(64)]
+
+def _indent(level):
+    if level < len(_INDENTS):
+        return _INDENTS[level]
+    return "  " * level
+
+# SequenceMatcher opcodes for two child-key lists. Most parents have zero
+# or one child, or identical children on both sides; those answers are
+# produced directly instead of building a matcher
+def _fast_opcodes(a, b):
+    if a == b:
+        return [('equal', 0, len(a), 0, len(b))] if a else []
+    if not a:
+        return [('insert', 0, 0, 0, len(b))]
+    if not b:
+        return [('delete', 0, len(a), 0, 0)]
+    if len(a) == 1 and len(b) == 1:
+        return [('replace', 0, 1, 0, 1)]
+    return _SequenceMatcher(None, a, b).get_opcodes()
+
+# A same-tag pair whose children are still being compared: the out
+# elements collect the changed children, pairs yields the next child pair
+_Frame = namedtuple('_Frame', 'node_a node_b out_a out_b pairs')
 
 class FilterModule(object):
     def filters(self):
@@ -21,22 +90,41 @@ class FilterModule(object):
         Unchanged subtrees are pruned from the output.
         """
         
-        # Helper for HTML escaping to ensure tags are visible in the report
-        def escape_html(s):
-            if not s: return ""
-            return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+        # Structural ids, shared by both documents: equal ids mean equal
+        # subtrees (tag, attributes, text and all children)
+        node_ids = {}
+        shape_ids = {}
+
+        # Numbers one node whose children are already numbered; parse_clean
+        # calls it in post-order
+        def number_node(node):
+            # Remove namespaces: compare on local names only
+            if node.tag[0] == '{':
+                node.tag = node.tag.split('}', 1)[1]
+            attrib = node.attrib
+            for name in [k for k in attrib.keys() if k[0] == '{']:
+                attrib[name.split('}', 1)[1]] = attrib.pop(name)
+            shape = (
+                node.tag,
+                tuple(sorted(node.attrib.items())),
+                (node.text or "").strip(),
+                tuple(node_ids[c] for c in node)
+            )
+            node_ids[node] = shape_ids.setdefault(shape, len(shape_ids))
 
         # 1. Normalize and Parse
+        # One pass: the end events arrive bottom-up, the last being the root
         def parse_clean(xml_str):
             if not xml_str or not xml_str.strip():
                 return None
-            # Remove namespaces
-            clean_xml = re.sub(r' xmlns="[^"]+"', '', xml_str, count=0)
-            clean_xml = re.sub(r' xmlns:[a-z0-9]+="[^"]+"', '', clean_xml, count=0)
+            root = None
             try:
-                return ET.fromstring(clean_xml)
+                for _, node in _iterparse(xml_str):
+                    number_node(node)
+                    root = node
             except ET.ParseError:
                 return None
+            return root
 
         root_before = parse_clean(before_xml)
         root_after = parse_clean(after_xml)
@@ -48,96 +136,90 @@ class FilterModule(object):
             "modified": 0
         }
 
-        # 2. Recursive Comparison
+        # 2. Comparison
+        # A pair either settles in start_pair or opens a _Frame whose
+        # children are compared before finish_pair completes it. Frames
+        # live on an explicit stack, so deep documents don't run into the
+        # recursion limit
         
-        def compare_nodes(node_a, node_b):
+        def start_pair(node_a, node_b):
             if node_a is None and node_b is None:
                 return (None, None, False)
 
             # Node Removed
             if node_b is None:
                 self.stats["removed"] += 1
-                res_a = deepcopy(node_a)
-                mark_tree(res_a, "color:#cc0000;") # Red
+                res_a = marked(node_a, "color:#cc0000;") # Red
                 return (res_a, None, True)
 
             # Node Added
             if node_a is None:
                 self.stats["added"] += 1
-                res_b = deepcopy(node_b)
-                mark_tree(res_b, "color:#00aa00;") # Green
+                res_b = marked(node_b, "color:#00aa00;") # Green
                 return (None, res_b, True)
 
+            # Identical subtrees have nothing to report; skip the descent
+            if node_ids[node_a] == node_ids[node_b]:
+                return (None, None, False)
+
             # Compare Tags
             if node_a.tag != node_b.tag:
                 self.stats["removed"] += 1
                 self.stats["added"] += 1
-                res_a = deepcopy(node_a)
-                res_b = deepcopy(node_b)
-                mark_tree(res_a, "color:#cc0000;")
-                mark_tree(res_b, "color:#00aa00;")
+                res_a = marked(node_a, "color:#cc0000;")
+                res_b = marked(node_b, "color:#00aa00;")
                 return (res_a, res_b, True)
 
-            # Compare Attributes & Text
-            text_a = (node_a.text or "").strip()
-            text_b = (node_b.text or "").strip()
-            is_modified = text_a != text_b
-            
-            # Simple attribute check
-            if node_a.attrib != node_b.attrib:
-                is_modified = True
-
             out_a = ET.Element(node_a.tag, attrib=node_a.attrib)
             out_b = ET.Element(node_b.tag, attrib=node_b.attrib)
-            
+            return _Frame(node_a, node_b, out_a, out_b, child_pairs(node_a, node_b))
+
+        # Yields the child pairs to compare, in output order
+        def child_pairs(node_a, node_b):
             children_a = list(node_a)
             children_b = list(node_b)
             
             # Map children by tags to find sequence matches
-            import difflib
-            s = difflib.SequenceMatcher(None, [c.tag for c in children_a], [c.tag for c in children_b])
-            
-            has_child_changes = False
+            opcodes = _fast_opcodes([c.tag for c in children_a], [c.tag for c in children_b])
 
-            for tag, i1, i2, j1, j2 in s.get_opcodes():
+            for tag, i1, i2, j1, j2 in opcodes:
                 if tag == 'equal':
                     for k in range(i2-i1):
-                        child_res_a, child_res_b, changed = compare_nodes(children_a[i1+k], children_b[j1+k])
-                        if changed:
-                            has_child_changes = True
-                            out_a.append(child_res_a)
-                            out_b.append(child_res_b)
-                elif tag == 'replace':
-                    has_child_changes = True
-                    for c in children_a[i1:i2]:
-                        r_a, _, _ = compare_nodes(c, None)
-                        out_a.append(r_a)
-                    for c in children_b[j1:j2]:
-                        _, r_b, _ = compare_nodes(None, c)
-                        out_b.append(r_b)
-                elif tag == 'delete':
-                    has_child_changes = True
+                        yield children_a[i1+k], children_b[j1+k]
+                else:
+                    # replace, delete and insert: removals first, then additions
                     for c in children_a[i1:i2]:
-                        r_a, _, _ = compare_nodes(c, None)
-                        out_a.append(r_a)
-                elif tag == 'insert':
-                    has_child_changes = True
+                        yield c, None
                     for c in children_b[j1:j2]:
-                        _, r_b, _ = compare_nodes(None, c)
-                        out_b.append(r_b)
+                        yield None, c
+
+        def finish_pair(frame):
+            node_a, node_b, out_a, out_b, _ = frame
+
+            # Compare Attributes & Text
+            text_a = (node_a.text or "").strip()
+            text_b = (node_b.text or "").strip()
+            is_modified = text_a != text_b
+            
+            # Simple attribute check
+            if node_a.attrib != node_b.attrib:
+                is_modified = True
+
+            # Only changed children were appended
+            has_child_changes = len(out_a) or len(out_b)
 
             # Text content check
             if is_modified:
                 self.stats["modified"] += 1
                 # Mark text specifically. Escape first, then wrap.
-                out_a.text = '<span style="color:#ff8800; font-weight:bold;">{}</span>'.format(escape_html(text_a))
-                out_b.text = '<span style="color:#ff8800; font-weight:bold;">{}</span>'.format(escape_html(text_b))
+                out_a.text = '<span style="color:#ff8800; font-weight:bold;">{}</span>'.format(_escape_html(text_a))
+                out_b.text = '<span style="color:#ff8800; font-weight:bold;">{}</span>'.format(_escape_html(text_b))
                 # Also mark tag slightly to indicate change inside
                 out_a.set('__diff_style__', 'color:#ff8800;') 
                 out_b.set('__diff_style__', 'color:#ff8800;')
             else:
-                out_a.text = escape_html(text_a)
-                out_b.text = escape_html(text_b)
+                out_a.text = _escape_html(text_a)
+                out_b.text = _escape_html(text_b)
             
             # PRUNING: If no text change and no child changes, return Nothing
             if not is_modified and not has_child_changes:
@@ -145,64 +227,103 @@ class FilterModule(object):
                 
             return (out_a, out_b, True)
 
-        def mark_tree(element, style):
-            if element is None: return
-            if element.text and element.text.strip():
-                # Escape existing text, then wrap
-                element.text = '<span style="{} font-weight:bold;">{}</span>'.format(style, escape_html(element.text))
-            
-            element.set('__diff_style__', style)
-            for child in element:
-                mark_tree(child, style)
+        def compare_nodes(node_a, node_b):
+            stack = []
+            res = start_pair(node_a, node_b)
+            while True:
+                if type(res) is _Frame:
+                    stack.append(res)
+                elif not stack:
+                    return res
+                elif res[2]:
+                    # Unchanged children are pruned from the output
+                    if res[0] is not None:
+                        stack[-1].out_a.append(res[0])
+                    if res[1] is not None:
+                        stack[-1].out_b.append(res[1])
+
+                frame = stack[-1]
+                pair = next(frame.pairs, None)
+                if pair is None:
+                    stack.pop()
+                    res = finish_pair(frame)
+                else:
+                    res = start_pair(*pair)
+
+        # Removed/added subtrees are not copied: the output tree only gets a
+        # placeholder, and serialize() marks and escapes the original nodes
+        # as it writes them out
+        marked_nodes = {}
+
+        def marked(element, style):
+            if element is None: return None
+            placeholder = ET.Element('__marked__', style=style)
+            marked_nodes[placeholder] = element
+            return placeholder
 
         result_left, result_right, any_change = compare_nodes(root_before, root_after)
 
         # 3. Custom Serializer (Avoids minidom whitespace issues & handles inline leaves)
-        def serialize(elem, level=0):
-            if elem is None: return ""
-            indent = "  " * level
-            
-            # Attributes
-            attrs = ""
-            for k, v in elem.attrib.items():
-                if not k.startswith('__'):
-                    attrs += ' {}="{}"'.format(k, v)
-            
-            tag = elem.tag
-            style = elem.get('__diff_style__')
-            
-            # Construct start/end tags TEXT (e.g. <tag>)
-            start_tag_text = "<{}{}>".format(tag, attrs)
-            end_tag_text = "</{}>".format(tag)
-            
-            # Escape for HTML display (e.g. &lt;tag&gt;)
-            start_tag_html = escape_html(start_tag_text)
-            end_tag_html = escape_html(end_tag_text)
-            
-            if style:
-                start_tag_html = '<span style="{}">{}</span>'.format(style, start_tag_html)
-                end_tag_html = '<span style="{}">{}</span>'.format(style, end_tag_html)
-            
-            # Leaf Node (Inline)
-            if len(elem) == 0:
-                text = elem.text or ""
-                # text is already escaped and possibly wrapped in spans in compare_nodes
-                return '{}{}{}{}
-'.format(indent, start_tag_html, text, end_tag_html)
-            
-            # Container Node
-            out = '{}{}
-'.format(indent, start_tag_html)
-            if elem.text and elem.text.strip():
-                 out += '{}  {}
-'.format(indent, elem.text.strip())
-            
-            for child in elem:
-                out += serialize(child, level + 1)
-            
-            out += '{}{}
-'.format(indent, end_tag_html)
-            return out
+        # Explicit-stack walk into one list; closing tags are pushed as plain
+        # strings so they are emitted after the element's children
+        def serialize(root):
+            if root is None: return ""
+            out = []
+            stack = [(root, 0, None)]
+            while stack:
+                item = stack.pop()
+                if isinstance(item, str):
+                    out.append(item)
+                    continue
+                # mark: diff style of the removed/added subtree being written
+                elem, level, mark = item
+                if elem.tag == '__marked__':
+                    mark = elem.get('style')
+                    elem = marked_nodes[elem]
+                indent = _indent(level)
+                
+                # Attributes
+                attrs = "".join(
+                    ' {}="{}"'.format(k, v)
+                    for k, v in elem.attrib.items() if not k.startswith('__')
+                )
+                
+                tag = elem.tag
+                text = elem.text
+                if mark:
+                    style = mark
+                    if text and text.strip():
+                        # Escape existing text, then wrap
+                        text = '<span style="{} font-weight:bold;">{}</span>'.format(mark, _escape_html(text))
+                else:
+                    style = elem.get('__diff_style__')
+                
+                # Construct start/end tags TEXT (e.g. <tag>)
+                start_tag_text = "<{}{}>".format(tag, attrs)
+                end_tag_text = "</{}>".format(tag)
+                
+                # Escape for HTML display (e.g. &lt;tag&gt;)
+                start_tag_html = _escape_html(start_tag_text)
+                end_tag_html = _escape_html(end_tag_text)
+                
+                if style:
+                    start_tag_html = '<span style="{}">{}</span>'.format(style, start_tag_html)
+                    end_tag_html = '<span style="{}">{}</span>'.format(style, end_tag_html)
+                
+                # Leaf Node (Inline)
+                if len(elem) == 0:
+                    # text is already escaped and possibly wrapped in spans
+                    out.append('{}{}{}{}\n'.format(indent, start_tag_html, text or "", end_tag_html))
+                    continue
+                
+                # Container Node
+                out.append('{}{}\n'.format(indent, start_tag_html))
+                if text and text.strip():
+                     out.append('{}  {}\n'.format(indent, text.strip()))
+                
+                stack.append('{}{}\n'.format(indent, end_tag_html))
+                stack.extend((child, level + 1, mark) for child in reversed(elem))
+            return "".join(out)
             
         left_out = serialize(result_left).strip()
         right_out = serialize(result_right).strip()
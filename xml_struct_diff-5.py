@@ -4,252 +4,386 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
-import re
-import xml.etree.ElementTree as ET
+import io
+from functools import lru_cache
 import difflib
-from copy import deepcopy
+from collections import namedtuple
+from itertools import zip_longest
 
-class FilterModule(object):
-    def filters(self):
-        return {
-            'xml_struct_diff': self.xml_struct_diff
-        }
+# lxml parses in C; the Element API used below is the same in both
+try:
+    from lxml import etree as ET
+    # Comments and PIs are dropped and internal entities expanded as
+    # ElementTree does (external ones never are), and the text is handed
+    # over as UTF-8 bytes so an encoding declaration in the document is
+    # ignored
+    _PARSE_OPTIONS = dict(
+        remove_blank_text=True,
+        remove_comments=True,
+        remove_pis=True,
+        resolve_entities='internal',
+        huge_tree=True,
+        encoding='utf-8',
+    )
+except ImportError:
+    import xml.etree.ElementTree as ET
+    _PARSE_OPTIONS = None
 
-    def xml_struct_diff(self, before_xml, after_xml):
-        """
-        Compares two XML strings (Before vs After) and returns a structured diff
-        preserving parent hierarchy with inline styling for reporting.
-        Unchanged subtrees are pruned from the output.
-        Ignores moved elements by canonically sorting the XML tree.
-        """
-        
-        # Helper for HTML escaping
-        def escape_html(s):
-            if not s: return ""
-            return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-
-        # Recursive Sorter to ignore moves
-        def sort_tree(node):
-            # Sort children by Tag, then Attributes, then Text
-            node[:] = sorted(node, key=lambda child: (
-                child.tag, 
-                sorted(child.attrib.items()), 
-                (child.text or "").strip()
-            ))
-            for child in node:
-                sort_tree(child)
-
-        # 1. Normalize and Parse
-        def parse_clean(xml_str):
-            if not xml_str or not xml_str.strip():
-                return None
-            # Remove namespaces
-            clean_xml = re.sub(r' xmlns="[^"]+"', '', xml_str, count=0)
-            clean_xml = re.sub(r' xmlns:[a-z0-9]+="[^"]+"', '', clean_xml, count=0)
-            try:
-                root = ET.fromstring(clean_xml)
-                sort_tree(root)
-                return root
-            except ET.ParseError:
-                return None
-
-        root_before = parse_clean(before_xml)
-        root_after = parse_clean(after_xml)
-
-        # Counters
-        self.stats = {
-            "added": 0,
-            "removed": 0,
-            "modified": 0
-        }
+# Yields every element at its end event: children always come before
+# their parent, so per-node work can be done while the tree is built
+def _iterparse(text):
+    if _PARSE_OPTIONS is None:
+        return ET.iterparse(io.StringIO(text), events=('end',))
+    return ET.iterparse(io.BytesIO(text.encode('utf-8')), events=('end',), **_PARSE_OPTIONS)
+
+_HTML_ESCAPE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+# Attribute values also need their quotes escaped
+_ATTR_ESCAPE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;"})
+
+# Helpers for HTML escaping, one translate pass each
+def _escape_html(s):
+    if not s: return ""
+    return s.translate(_HTML_ESCAPE)
+
+def _escape_attr(s):
+    if not s: return ""
+    return s.translate(_ATTR_ESCAPE)
+
+# Indent styles per nesting level, built once
+_INDENT_STYLES = ["padding-left: {}px;".format(i * 20) for i in range(64)]
+
+def _indent_style(level):
+    if level < len(_INDENT_STYLES):
+        return _INDENT_STYLES[level]
+    return "padding-left: {}px;".format(level * 20)
 
-        # Helper to calculate rendered line count for spacers
-        def count_lines(elem, is_leaf=False):
-            if elem is None: return 0
-            if is_leaf: return 1 # <tag>value</tag> is 1 line
+# Diff styles and the span markup built from them, shared by every node
+_REMOVED_STYLE = "color:#cc0000;" # Red
+_ADDED_STYLE = "color:#00aa00;" # Green
+_MODIFIED_STYLE = "color:#ff8800;"
+_DEFAULT_TAG_STYLE = "color: #6b7280;"
+_BOLD_SPANS = {
+    style: '<span style="{} font-weight:bold;">'.format(style)
+    for style in (_REMOVED_STYLE, _ADDED_STYLE, _MODIFIED_STYLE)
+}
+_SPAN_END = '</span>'
+
+# Unchanged text is shown in the default colour
+_PLAIN_TEXT_SPAN = '<span style="color: #374151;">'
+
+# compare_nodes output. Only serialize() reads it, so a tuple does instead
+# of an Element; attrib is the source node's dict, which is never changed
+_DiffNode = namedtuple('_DiffNode', 'tag attrib text children diff_style')
+
+# Removed/added subtrees are not copied: the output only holds a reference
+# to the original node, and serialize() marks and escapes it as it writes
+# the subtree out. append_spacer pads the block to its peer's height
+_Marked = namedtuple('_Marked', 'node style append_spacer')
+
+# Blank lines standing in for a block that only exists on the other side
+_Spacer = namedtuple('_Spacer', 'lines')
+
+# A same-tag pair whose children are still being compared: out_a and
+# out_b collect the changed children, pairs yields the next child pair
+_Frame = namedtuple('_Frame', 'node_a node_b out_a out_b pairs')
+
+# The diff engine is a pure function of the two input strings. Playbooks
+# often run the filter again on the same payloads for every host, so the
+# most recent results are kept. Each entry holds both input strings and
+# both reports, hence the small size
+@lru_cache(maxsize=16)
+def _struct_diff(before_xml, after_xml):
+    # Structural ids, shared by both documents: equal ids mean equal
+    # subtrees (tag, attributes, text and all children)
+    node_ids = {}
+    shape_ids = {}
+    # Attribute-set ids, also shared: nodes have equal attributes exactly
+    # when their ids match, so compare_nodes tests two ints instead of two
+    # attribute dicts
+    attr_ids = {}
+    node_attrs = {}
+    # Rendered line count of each subtree, used to size spacers
+    node_lines = {}
+
+    # Sort key of every node, built exactly once when the node is finished
+    # and reused as the start of its shape
+    sort_keys = {}
+
+    # Sorts the children of one node to ignore moves, then numbers and
+    # measures it; parse_clean calls it in post-order, so the children
+    # are already finished
+    def sort_and_number(node):
+        # Remove namespaces: compare on local names only
+        if node.tag[0] == '{':
+            node.tag = node.tag.split('}', 1)[1]
+        attrib = node.attrib
+        for name in [k for k in attrib.keys() if k[0] == '{']:
+            attrib[name.split('}', 1)[1]] = attrib.pop(name)
+        # Sort children by Tag, then Attributes, then Text
+        if len(node) > 1:
+            node[:] = sorted(node, key=sort_keys.__getitem__)
+        attrs = tuple(sorted(attrib.items()))
+        node_attrs[node] = attr_ids.setdefault(attrs, len(attr_ids))
+        key = (
+            node.tag,
+            attrs,
+            (node.text or "").strip()
+        )
+        sort_keys[node] = key
+        shape = key + (tuple(node_ids[c] for c in node),)
+        node_ids[node] = shape_ids.setdefault(shape, len(shape_ids))
+        # A leaf is one line (<tag>value</tag>); a container has open
+        # and close tags, a line for any text, and its children
+        if len(node) == 0:
+            node_lines[node] = 1
+        else:
+            node_lines[node] = (3 if key[2] else 2) + sum(node_lines[c] for c in node)
+
+    # 1. Normalize and Parse
+    # One pass: the end events arrive bottom-up, the last being the root
+    def parse_clean(xml_str):
+        if not xml_str or not xml_str.strip():
+            return None
+        root = None
+        try:
+            for _, node in _iterparse(xml_str):
+                sort_and_number(node)
+                root = node
+        except ET.ParseError:
+            return None
+        return root
+
+    root_before = parse_clean(before_xml)
+    root_after = parse_clean(after_xml)
+
+    # Counters
+    stats = {
+        "added": 0,
+        "removed": 0,
+        "modified": 0
+    }
+
+    # 2. Comparison
+    # A pair either settles in start_pair or opens a _Frame whose children
+    # are compared before finish_pair completes it. Frames live on an
+    # explicit stack, so deep documents don't run into the recursion limit
+
+    def start_pair(node_a, node_b):
+        if node_a is None and node_b is None:
+            return (None, None, False)
+
+        # Node Removed
+        if node_b is None:
+            stats["removed"] += 1
+            res_a = _Marked(node_a, _REMOVED_STYLE, 0)
+            # Count lines for spacer
+            return (res_a, _Spacer(node_lines[node_a]), True)
+
+        # Node Added
+        if node_a is None:
+            stats["added"] += 1
+            res_b = _Marked(node_b, _ADDED_STYLE, 0)
+            return (_Spacer(node_lines[node_b]), res_b, True)
+
+        # Identical subtrees have nothing to report; skip the descent
+        if node_ids[node_a] == node_ids[node_b]:
+            return (None, None, False)
+
+        # Compare Tags (Since we sorted, mismatch usually means total difference)
+        if node_a.tag != node_b.tag:
+            stats["removed"] += 1
+            stats["added"] += 1
+            # Balance lines
+            lines_a = node_lines[node_a]
+            lines_b = node_lines[node_b]
             
-            # Open tag (1) + Text content (0 or 1) + Children + Close tag (1)
-            lines = 2 
-            if elem.text and elem.text.strip():
-                lines += 1
-            for child in elem:
-                # Check if child is leaf
-                child_is_leaf = (len(child) == 0)
-                lines += count_lines(child, child_is_leaf)
-            return lines
-
-        # 2. Recursive Comparison
+            res_a = _Marked(node_a, _REMOVED_STYLE, max(lines_b - lines_a, 0))
+            res_b = _Marked(node_b, _ADDED_STYLE, max(lines_a - lines_b, 0))
+            return (res_a, res_b, True)
+
+        return _Frame(node_a, node_b, [], [], child_pairs(node_a, node_b))
+
+    # Yields the child pairs to compare. Since sorted, we iterate in lockstep
+    # Note: This is a simplified diff for sorted trees. 
+    # A more complex Myers diff could be used here if inserts cause massive shifts,
+    # but for config normalization, sorted alignment is usually sufficient.
+    # (zip_longest pads the shorter side with None)
+    def child_pairs(node_a, node_b):
+        return zip_longest(node_a, node_b)
+
+    def finish_pair(frame):
+        node_a, node_b, out_a, out_b, _ = frame
+
+        # Compare Attributes & Text
+        text_a = (node_a.text or "").strip()
+        text_b = (node_b.text or "").strip()
+        is_modified = text_a != text_b
         
-        def compare_nodes(node_a, node_b):
-            if node_a is None and node_b is None:
-                return (None, None, False)
-
-            # Node Removed
-            if node_b is None:
-                self.stats["removed"] += 1
-                res_a = deepcopy(node_a)
-                mark_tree(res_a, "color:#cc0000;") # Red
-                # Count lines for spacer
-                lines = count_lines(res_a, len(res_a) == 0)
-                res_b_spacer = ET.Element("__spacer__", lines=str(lines))
-                return (res_a, res_b_spacer, True)
-
-            # Node Added
-            if node_a is None:
-                self.stats["added"] += 1
-                res_b = deepcopy(node_b)
-                mark_tree(res_b, "color:#00aa00;") # Green
-                lines = count_lines(res_b, len(res_b) == 0)
-                res_a_spacer = ET.Element("__spacer__", lines=str(lines))
-                return (res_a_spacer, res_b, True)
-
-            # Compare Tags (Since we sorted, mismatch usually means total difference)
-            if node_a.tag != node_b.tag:
-                self.stats["removed"] += 1
-                self.stats["added"] += 1
-                res_a = deepcopy(node_a)
-                res_b = deepcopy(node_b)
-                mark_tree(res_a, "color:#cc0000;")
-                mark_tree(res_b, "color:#00aa00;")
-                
-                # Balance lines
-                lines_a = count_lines(res_a, len(res_a)==0)
-                lines_b = count_lines(res_b, len(res_b)==0)
-                
-                if lines_a < lines_b:
-                    res_a.set('__append_spacer__', str(lines_b - lines_a))
-                elif lines_b < lines_a:
-                    res_b.set('__append_spacer__', str(lines_a - lines_b))
-                    
-                return (res_a, res_b, True)
-
-            # Compare Attributes & Text
-            text_a = (node_a.text or "").strip()
-            text_b = (node_b.text or "").strip()
-            is_modified = text_a != text_b
-            
-            if node_a.attrib != node_b.attrib:
-                is_modified = True
+        if node_attrs[node_a] != node_attrs[node_b]:
+            is_modified = True
 
-            out_a = ET.Element(node_a.tag, attrib=node_a.attrib)
-            out_b = ET.Element(node_b.tag, attrib=node_b.attrib)
-            
-            children_a = list(node_a)
-            children_b = list(node_b)
-            
-            # Since sorted, we iterate in lockstep
-            # Note: This is a simplified diff for sorted trees. 
-            # A more complex Myers diff could be used here if inserts cause massive shifts,
-            # but for config normalization, sorted alignment is usually sufficient.
-            
-            has_child_changes = False
-            max_len = max(len(children_a), len(children_b))
-            
-            for i in range(max_len):
-                c_a = children_a[i] if i < len(children_a) else None
-                c_b = children_b[i] if i < len(children_b) else None
-                
-                child_res_a, child_res_b, changed = compare_nodes(c_a, c_b)
-                if changed:
-                    has_child_changes = True
-                    out_a.append(child_res_a)
-                    out_b.append(child_res_b)
-
-            # Text content check
-            if is_modified:
-                self.stats["modified"] += 1
-                # Mark text specifically. Escape first, then wrap.
-                out_a.text = '<span style="color:#ff8800; font-weight:bold;">{}</span>'.format(escape_html(text_a))
-                out_b.text = '<span style="color:#ff8800; font-weight:bold;">{}</span>'.format(escape_html(text_b))
-                out_a.set('__diff_style__', 'color:#ff8800;') 
-                out_b.set('__diff_style__', 'color:#ff8800;')
-            else:
-                out_a.text = escape_html(text_a)
-                out_b.text = escape_html(text_b)
-            
-            # PRUNING: If no text change and no child changes, return Nothing
-            if not is_modified and not has_child_changes:
-                return (None, None, False)
-                
-            return (out_a, out_b, True)
+        # Only changed children were appended
+        has_child_changes = bool(out_a or out_b)
+
+        # PRUNING: If no text change and no child changes, return Nothing
+        if not is_modified and not has_child_changes:
+            return (None, None, False)
 
-        def mark_tree(element, style):
-            if element is None: return
-            if element.text and element.text.strip():
-                element.text = '<span style="{} font-weight:bold;">{}</span>'.format(style, escape_html(element.text))
+        # Text content check
+        if is_modified:
+            stats["modified"] += 1
+            # Mark text specifically. Escape first, then wrap.
+            text_a = _BOLD_SPANS[_MODIFIED_STYLE] + _escape_html(text_a) + _SPAN_END
+            text_b = _BOLD_SPANS[_MODIFIED_STYLE] + _escape_html(text_b) + _SPAN_END
+            style = _MODIFIED_STYLE
+        else:
+            text_a = _escape_html(text_a)
+            text_b = _escape_html(text_b)
+            style = None
             
-            element.set('__diff_style__', style)
-            for child in element:
-                mark_tree(child, style)
+        return (
+            _DiffNode(node_a.tag, node_a.attrib, text_a, out_a, style),
+            _DiffNode(node_b.tag, node_b.attrib, text_b, out_b, style),
+            True
+        )
+
+    def compare_nodes(node_a, node_b):
+        stack = []
+        res = start_pair(node_a, node_b)
+        while True:
+            if type(res) is _Frame:
+                stack.append(res)
+            elif not stack:
+                return res
+            elif res[2]:
+                # Unchanged children are pruned from the output
+                if res[0] is not None:
+                    stack[-1].out_a.append(res[0])
+                if res[1] is not None:
+                    stack[-1].out_b.append(res[1])
+
+            frame = stack[-1]
+            pair = next(frame.pairs, None)
+            if pair is None:
+                stack.pop()
+                res = finish_pair(frame)
+            else:
+                res = start_pair(*pair)
 
-        result_left, result_right, any_change = compare_nodes(root_before, root_after)
+    result_left, result_right, any_change = compare_nodes(root_before, root_after)
 
-        # 3. Custom Serializer
-        def serialize(elem, level=0):
-            if elem is None: return ""
+    # 3. Custom Serializer
+    # Explicit-stack walk into one list; closing tags are pushed as plain
+    # strings so they are emitted after the element's children
+    def serialize(root):
+        if root is None: return ""
+        out = []
+        stack = [(root, 0, None)]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                out.append(item)
+                continue
+            # mark: diff style of the removed/added subtree being written
+            elem, level, mark = item
             
             # Handle Spacer Nodes
-            if elem.tag == "__spacer__":
-                lines = int(elem.get('lines', 1))
-                return "".join(['<div class="spacer">&nbsp;</div>' for _ in range(lines)])
+            if type(elem) is _Spacer:
+                out.append('<div class="spacer">&nbsp;</div>' * elem.lines)
+                continue
+
+            # Check for appended spacers (for balancing mismatched blocks)
+            spacer_html = ""
+            if type(elem) is _Marked:
+                spacer_html = '<div class="spacer">&nbsp;</div>' * elem.append_spacer
+                mark = elem.style
+                elem = elem.node
 
-            indent_style = "padding-left: {}px;".format(level * 20)
+            indent_style = _indent_style(level)
             
             # Attributes
-            attrs = ""
-            for k, v in elem.attrib.items():
-                if not k.startswith('__'):
-                    val = escape_html(v).replace('"', '&quot;')
-                    attrs += ' {}="{}"'.format(k, val)
+            attrs = "".join(
+                ' {}="{}"'.format(k, _escape_attr(v))
+                for k, v in elem.attrib.items() if not k.startswith('__')
+            )
             
             tag = elem.tag
-            diff_style = elem.get('__diff_style__')
-            tag_style = diff_style if diff_style else "color: #6b7280;"
+            text = elem.text
+            # wrapped: text already carries its diff span, so it must not get
+            # the default colour; compare_nodes wraps the text of every node
+            # it styles, and marked subtrees wrap any non-blank text
+            if type(elem) is _DiffNode:
+                diff_style = elem.diff_style
+                wrapped = diff_style is not None
+                children = elem.children
+            else:
+                diff_style = mark
+                wrapped = bool(text and text.strip())
+                children = elem
+                if wrapped:
+                    text = _BOLD_SPANS[mark] + _escape_html(text) + _SPAN_END
+            tag_style = diff_style if diff_style else _DEFAULT_TAG_STYLE
             
             start_tag_html = '<span style="{}">&lt;{}{}&gt;</span>'.format(tag_style, tag, attrs)
             end_tag_html = '<span style="{}">&lt;/{}&gt;</span>'.format(tag_style, tag)
             
-            # Check for appended spacers (for balancing mismatched blocks)
-            append_spacer = int(elem.get('__append_spacer__', 0))
-            spacer_html = "".join(['<div class="spacer">&nbsp;</div>' for _ in range(append_spacer)])
-
             # LEAF NODE (Inline)
-            if len(elem) == 0:
-                text = elem.text or ""
+            if len(children) == 0:
+                text = text or ""
                 content_html = text
-                if not content_html.startswith('<span'):
-                    content_html = '<span style="color: #374151;">{}</span>'.format(content_html)
+                if not wrapped:
+                    content_html = _PLAIN_TEXT_SPAN + content_html + _SPAN_END
                 
-                # Corrected format string (4 args)
-                return '<div style="{}">{}{}{}</div>{}'.format(indent_style, start_tag_html, content_html, end_tag_html, spacer_html)
+                out.append('<div style="{}">{}{}{}</div>{}'.format(indent_style, start_tag_html, content_html, end_tag_html, spacer_html))
+                continue
             
             # CONTAINER NODE
-            out = '<div style="{}">{}</div>'.format(indent_style, start_tag_html)
+            out.append('<div style="{}">{}</div>'.format(indent_style, start_tag_html))
             
-            if elem.text and elem.text.strip():
-                text_indent = "padding-left: {}px;".format((level * 20) + 20)
-                text_content = elem.text.strip()
-                if not text_content.startswith('<span'):
-                    text_content = '<span style="color: #374151;">{}</span>'.format(text_content)
-                out += '<div style="{}">{}</div>'.format(text_indent, text_content)
-                
-            for child in elem:
-                out += serialize(child, level + 1)
-                
-            out += '<div style="{}">{}</div>'.format(indent_style, end_tag_html)
-            out += spacer_html
-            return out
+            if text and text.strip():
+                text_indent = _indent_style(level + 1)
+                text_content = text.strip()
+                if not wrapped:
+                    text_content = _PLAIN_TEXT_SPAN + text_content + _SPAN_END
+                out.append('<div style="{}">{}</div>'.format(text_indent, text_content))
             
-        left_out = serialize(result_left)
-        right_out = serialize(result_right)
+            stack.append('<div style="{}">{}</div>{}'.format(indent_style, end_tag_html, spacer_html))
+            stack.extend((child, level + 1, mark) for child in reversed(children))
+        return "".join(out)
+        
+    left_out = serialize(result_left)
+    right_out = serialize(result_right)
+
+    return {
+        "left": left_out if left_out else '<div class="text-gray-400 italic p-4">No Changes</div>',
+        "right": right_out if right_out else '<div class="text-gray-400 italic p-4">No Changes</div>',
+        "metadata": {
+            "changed": any_change,
+            "added_count": stats["added"],
+            "removed_count": stats["removed"],
+            "changed_count": stats["modified"]
+        }
+    }
 
+class FilterModule(object):
+    def filters(self):
         return {
-            "left": left_out if left_out else '<div class="text-gray-400 italic p-4">No Changes</div>',
-            "right": right_out if right_out else '<div class="text-gray-400 italic p-4">No Changes</div>',
-            "metadata": {
-                "changed": any_change,
-                "added_count": self.stats["added"],
-                "removed_count": self.stats["removed"],
-                "changed_count": self.stats["modified"]
-            }
+            'xml_struct_diff': self.xml_struct_diff
+        }
+
+    def xml_struct_diff(self, before_xml, after_xml):
+        """
+        Compares two XML strings (Before vs After) and returns a structured diff
+        preserving parent hierarchy with inline styling for reporting.
+        Unchanged subtrees are pruned from the output.
+        Ignores moved elements by canonically sorting the XML tree.
+        """
+        result = _struct_diff(before_xml, after_xml)
+        metadata = result["metadata"]
+        self.stats = {
+            "added": metadata["added_count"],
+            "removed": metadata["removed_count"],
+            "modified": metadata["changed_count"]
         }
+        # Callers get their own dicts so the cached result can't be changed
+        return dict(result, metadata=dict(metadata))
@@ -5,311 +5,464 @@ from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
 import re
-import xml.etree.ElementTree as ET
-from copy import deepcopy
+from sys import intern
+from functools import lru_cache
+from collections import namedtuple
 
-class FilterModule(object):
-    def filters(self):
+# lxml parses in C; the Element API used below is the same in both
+try:
+    from lxml import etree as ET
+    # Comments and PIs are dropped and internal entities expanded as
+    # ElementTree does (external ones never are), and the text is handed
+    # over as UTF-8 bytes so an encoding declaration in the document is
+    # ignored
+    _PARSER = ET.XMLParser(
+        remove_blank_text=True,
+        remove_comments=True,
+        remove_pis=True,
+        resolve_entities='internal',
+        huge_tree=True,
+        encoding='utf-8',
+    )
+except ImportError:
+    import xml.etree.ElementTree as ET
+    _PARSER = None
+
+def _fromstring(text):
+    if _PARSER is None:
+        return ET.fromstring(text)
+    return ET.fromstring(text.encode('utf-8'), _PARSER)
+
+# Default and prefixed namespace declarations, stripped in a single scan
+_NS_RE = re.compile(r' xmlns(?::[a-z0-9]+)?="[^"]+"')
+
+# One blank line of a spacer block
+_SPACER = '<div class="spacer">&nbsp;</div>'
+
+_HTML_ESCAPE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+# Attribute values also need their quotes escaped
+_ATTR_ESCAPE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;"})
+
+# Helpers for HTML escaping, one translate pass each
+def _escape_html(s):
+    if not s: return ""
+    return s.translate(_HTML_ESCAPE)
+
+def _escape_attr(s):
+    if not s: return ""
+    return s.translate(_ATTR_ESCAPE)
+
+# Shown on a side that has nothing to report
+_NO_CHANGES = '<div class="text-gray-400 italic p-4">No Changes</div>'
+
+# A same-tag pair whose children are still being compared. slot_a and
+# slot_b hold the place of its opening tags in the HTML, child_lines
+# collects the (left, right) heights of its changed children and pairs
+# yields the next child pair
+_Frame = namedtuple('_Frame', 'node_a node_b level slot_a slot_b child_lines pairs')
+
+# Indent styles per nesting level, built once
+_INDENT_STYLES = ["padding-left: {}px;".format(i * 20) for i in range(64)]
+
+def _indent_style(level):
+    if level < len(_INDENT_STYLES):
+        return _INDENT_STYLES[level]
+    return "padding-left: {}px;".format(level * 20)
+
+# Children that identify their parent, in priority order (common in
+# NETCONF); this helps align <vlan> nodes by their <id> even if out of order
+_ID_TAGS = ('id', 'name', 'key', 'neighbor-address', 'prefix', 'vlan-id')
+_ID_TAG_SET = frozenset(_ID_TAGS)
+
+# The diff engine is a pure function of the two input strings. Playbooks
+# often run the filter again on the same payloads for every host, so the
+# most recent results are kept. Each entry holds both input strings and
+# both reports, hence the small size
+@lru_cache(maxsize=16)
+def _struct_diff(before_xml, after_xml):
+    # Identical inputs cannot differ: skip parsing, sorting and diffing
+    if before_xml == after_xml:
         return {
-            'xml_struct_diff': self.xml_struct_diff
+            "left": _NO_CHANGES,
+            "right": _NO_CHANGES,
+            "metadata": {
+                "changed": False,
+                "added_count": 0,
+                "removed_count": 0,
+                "changed_count": 0
+            }
         }
+    
+    # --- Helpers ---
 
-    def xml_struct_diff(self, before_xml, after_xml):
+    # Identity key of every parsed node, built once by sort_tree
+    identity_keys = {}
+    # Structural ids, shared by both documents: equal ids mean equal
+    # subtrees (tag, attributes, text and all children), so compare_nodes
+    # can drop an unchanged subtree without walking it
+    node_ids = {}
+    shape_ids = {}
+    # Visual height (lines) of every parsed node, for spacer generation.
+    # Filled as the nodes are sorted, never re-walked
+    line_counts = {}
+
+    def build_identity_key(node):
         """
-        Compares two XML strings (Before vs After) using a structural merge-join strategy.
-        1. Normalizes and removes namespaces.
-        2. Canonically sorts elements based on "Identity Keys" (Tags + specific ID children like <name>, <id>).
-        3. Compares trees using a merge-join algorithm to correctly handle insertions/removals in lists.
-        4. Generates HTML-ready output with inline styles and spacer blocks for synchronized scrolling.
+        Generates a comparison key for a node.
+        Priority: Tag -> Attributes -> ID Child Value -> Text Content
+        The layout is fixed, (tag, attributes, identifier), so keys of
+        any two nodes compare without mixing tuples and strings.
+        Every string is interned: the same tags and ids recur across both
+        documents, and equal keys then compare by identity.
         """
+        # Attributes, as a sorted tuple of pairs (empty when there are none)
+        attrs = tuple(sorted(node.attrib.items())) if node.attrib else ()
+            
+        # Look for Identifying Children: one scan records the first child
+        # of each identifying tag, as find() would return it
+        id_children = {}
+        for child in node:
+            if child.tag in _ID_TAG_SET and child.tag not in id_children:
+                id_children[child.tag] = child
+        ident = ""
+        for k in _ID_TAGS:
+            child = id_children.get(k)
+            if child is not None and child.text:
+                ident = intern(k + ":" + child.text.strip())
+                break
         
-        # --- Helpers ---
+        # Fallback: Use text content if it's a leaf-like node
+        if not ident:
+            txt = (node.text or "").strip()
+            if txt:
+                ident = intern("text:" + txt)
         
-        def escape_html(s):
-            if not s: return ""
-            return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-
-        def get_identity_key(node):
-            """
-            Generates a comparison key for a node.
-            Priority: Tag -> Attributes -> ID Child Value -> Text Content
-            """
-            key_parts = [node.tag]
-            
-            # Attributes
-            if node.attrib:
-                key_parts.append(str(sorted(node.attrib.items())))
-                
-            # Look for Identifying Children (Common in NETCONF)
-            # This helps align <vlan> nodes by their <id> even if out of order
-            found_id = False
-            for k in ['id', 'name', 'key', 'neighbor-address', 'prefix', 'vlan-id']:
-                child = node.find(k)
-                if child is not None and child.text:
-                    key_parts.append(k + ":" + child.text.strip())
-                    found_id = True
-                    break
-            
-            # Fallback: Use text content if it's a leaf-like node
-            if not found_id:
-                txt = (node.text or "").strip()
-                if txt:
-                    key_parts.append("text:" + txt)
-            
-            return tuple(key_parts)
-
-        def sort_tree(node):
-            """Recursively sorts children by identity key."""
-            node[:] = sorted(node, key=get_identity_key)
-            for child in node:
-                sort_tree(child)
-
-        def count_lines(elem, is_leaf=False):
-            """
-            Calculates visual height (lines) of an element for spacer generation.
-            """
-            if elem is None: return 0
-            
-            # Check for explicitly set spacer lines
-            if elem.tag == "__spacer__":
-                return int(elem.get('lines', 0))
-            
-            # Leaf node <tag>val</tag> is 1 line
-            if len(elem) == 0:
-                return 1
-                
-            # Container: OpenTag + (Text?) + Children + CloseTag
-            lines = 2 
-            if elem.text and elem.text.strip():
-                lines += 1
-                
-            for child in elem:
-                lines += count_lines(child)
-                
-            # Add appended spacers
-            lines += int(elem.get('__append_spacer__', 0))
-            return lines
-
-        # --- Main Logic ---
-
-        def parse_clean(xml_str):
-            if not xml_str or not xml_str.strip():
-                return None
-            # Remove namespaces
-            clean_xml = re.sub(r' xmlns="[^"]+"', '', xml_str, count=0)
-            clean_xml = re.sub(r' xmlns:[a-z0-9]+="[^"]+"', '', clean_xml, count=0)
-            try:
-                root = ET.fromstring(clean_xml)
-                sort_tree(root)
-                return root
-            except ET.ParseError:
-                return None
-
-        root_before = parse_clean(before_xml)
-        root_after = parse_clean(after_xml)
-
-        self.stats = {"added": 0, "removed": 0, "modified": 0}
-
-        def mark_tree(element, style):
-            """Recursively marks a tree as added/removed."""
-            if element is None: return
-            if element.text and element.text.strip():
-                element.text = '<span style="{} font-weight:bold;">{}</span>'.format(style, escape_html(element.text))
-            
-            element.set('__diff_style__', style)
-            for child in element:
-                mark_tree(child, style)
-
-        def compare_nodes(node_a, node_b):
-            # Case 0: Both None
-            if node_a is None and node_b is None:
-                return (None, None, False)
-
-            # Case 1: Removal (A exists, B is None)
-            if node_b is None:
-                self.stats["removed"] += 1
-                res_a = deepcopy(node_a)
-                mark_tree(res_a, "color:#cc0000;") # Red
-                lines = count_lines(res_a)
-                res_b_spacer = ET.Element("__spacer__", lines=str(lines))
-                return (res_a, res_b_spacer, True)
-
-            # Case 2: Addition (A is None, B exists)
-            if node_a is None:
-                self.stats["added"] += 1
-                res_b = deepcopy(node_b)
-                mark_tree(res_b, "color:#00aa00;") # Green
-                lines = count_lines(res_b)
-                res_a_spacer = ET.Element("__spacer__", lines=str(lines))
-                return (res_a_spacer, res_b, True)
-
-            # Case 3: Different Tags (treat as remove + add)
-            # Note: With identity key sorting, this rarely happens unless key matched but tag differed?
-            # Actually, key includes tag, so this block might be unreachable via merge-join, 
-            # but safe to keep for root or direct calls.
-            if node_a.tag != node_b.tag:
-                self.stats["removed"] += 1
-                self.stats["added"] += 1
-                res_a = deepcopy(node_a)
-                res_b = deepcopy(node_b)
-                mark_tree(res_a, "color:#cc0000;")
-                mark_tree(res_b, "color:#00aa00;")
-                
-                # Balance lines
-                lines_a = count_lines(res_a)
-                lines_b = count_lines(res_b)
-                max_lines = max(lines_a, lines_b)
-                
-                if lines_a < max_lines: res_a.set('__append_spacer__', str(max_lines - lines_a))
-                if lines_b < max_lines: res_b.set('__append_spacer__', str(max_lines - lines_b))
-                    
-                return (res_a, res_b, True)
-
-            # Case 4: Same Tag - Compare Internals
-            text_a = (node_a.text or "").strip()
-            text_b = (node_b.text or "").strip()
-            text_changed = text_a != text_b
-            
-            out_a = ET.Element(node_a.tag, attrib=node_a.attrib)
-            out_b = ET.Element(node_b.tag, attrib=node_b.attrib)
-            
-            has_child_changes = False
-            
-            # --- Merge-Join Children ---
-            children_a = list(node_a) # Sorted
-            children_b = list(node_b) # Sorted
+        return (intern(node.tag), attrs, ident)
+
+    def sort_tree(root):
+        """
+        Sorts children by identity key. Post-order with an explicit stack:
+        a node's key, structural id and line count are built once, after
+        its own children are in order, numbered and counted.
+        """
+        stack = [(root, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if not children_done:
+                stack.append((node, True))
+                stack.extend((child, False) for child in node)
+                continue
+            if len(node) > 1:
+                node[:] = sorted(node, key=identity_keys.__getitem__)
+            key = identity_keys[node] = build_identity_key(node)
+            shape = (key[0], key[1], (node.text or "").strip(), tuple(node_ids[c] for c in node))
+            node_ids[node] = shape_ids.setdefault(shape, len(shape_ids))
+            line_counts[node] = count_lines(node)
+
+    def count_lines(elem):
+        """
+        Calculates visual height (lines) of an element whose children are
+        already in line_counts. Appended spacers are not included.
+        """
+        # Leaf node <tag>val</tag> is 1 line
+        if len(elem) == 0:
+            return 1
             
-            idx_a = 0
-            idx_b = 0
-            len_a = len(children_a)
-            len_b = len(children_b)
+        # Container: OpenTag + (Text?) + Children + CloseTag
+        lines = 2 
+        if elem.text and elem.text.strip():
+            lines += 1
             
-            while idx_a < len_a or idx_b < len_b:
-                c_a = children_a[idx_a] if idx_a < len_a else None
-                c_b = children_b[idx_b] if idx_b < len_b else None
-                
-                k_a = get_identity_key(c_a) if c_a is not None else None
-                k_b = get_identity_key(c_b) if c_b is not None else None
-                
-                # Match
-                if k_a == k_b:
-                    res_child_a, res_child_b, changed = compare_nodes(c_a, c_b)
-                    if changed: has_child_changes = True
-                    out_a.append(res_child_a)
-                    out_b.append(res_child_b)
-                    idx_a += 1
-                    idx_b += 1
-                
-                # Removed (A < B or B exhausted)
-                elif c_b is None or (c_a is not None and k_a < k_b):
-                    res_child_a, res_child_b, changed = compare_nodes(c_a, None)
-                    has_child_changes = True
-                    out_a.append(res_child_a)
-                    out_b.append(res_child_b)
-                    idx_a += 1
-                    
-                # Added (B < A or A exhausted)
-                else:
-                    res_child_a, res_child_b, changed = compare_nodes(None, c_b)
-                    has_child_changes = True
-                    out_a.append(res_child_a)
-                    out_b.append(res_child_b)
-                    idx_b += 1
-
-            # --- Text Content ---
-            if text_changed:
-                self.stats["modified"] += 1
-                out_a.text = '<span style="color:#ff8800; font-weight:bold;">{}</span>'.format(escape_html(text_a))
-                out_b.text = '<span style="color:#ff8800; font-weight:bold;">{}</span>'.format(escape_html(text_b))
-                out_a.set('__diff_style__', 'color:#ff8800;') 
-                out_b.set('__diff_style__', 'color:#ff8800;')
-            else:
-                out_a.text = escape_html(text_a)
-                out_b.text = escape_html(text_b)
+        for child in elem:
+            lines += line_counts[child]
+        return lines
 
-            # --- Pruning ---
-            if not text_changed and not has_child_changes:
-                return (None, None, False)
+    # --- Main Logic ---
 
-            # --- Final Balancing (Crucial for Side-by-Side) ---
-            l_lines = count_lines(out_a)
-            r_lines = count_lines(out_b)
-            
-            if l_lines < r_lines:
-                out_a.set('__append_spacer__', str(r_lines - l_lines))
-            elif r_lines < l_lines:
-                out_b.set('__append_spacer__', str(l_lines - r_lines))
+    def parse_clean(xml_str):
+        if not xml_str or not xml_str.strip():
+            return None
+        # Remove namespaces
+        clean_xml = _NS_RE.sub('', xml_str)
+        try:
+            root = _fromstring(clean_xml)
+            sort_tree(root)
+            return root
+        except ET.ParseError:
+            return None
 
-            return (out_a, out_b, True)
+    root_before = parse_clean(before_xml)
+    root_after = parse_clean(after_xml)
 
-        # Start Comparison
-        result_left, result_right, any_change = compare_nodes(root_before, root_after)
+    stats = {"added": 0, "removed": 0, "modified": 0}
 
-        # 4. Serialize to HTML
-        def serialize(elem, level=0):
-            if elem is None: return ""
-            
-            # Spacer
-            if elem.tag == "__spacer__":
-                lines = int(elem.get('lines', 1))
-                return "".join(['<div class="spacer">&nbsp;</div>' for _ in range(lines)])
+    def tag_html(node, tag_style):
+        """Returns the start and end tag spans of a node."""
+        attrs = "".join(
+            ' {}="{}"'.format(k, _escape_attr(v))
+            for k, v in node.attrib.items()
+        )
+        start_tag_html = '<span style="{}">&lt;{}{}&gt;</span>'.format(tag_style, node.tag, attrs)
+        end_tag_html = '<span style="{}">&lt;/{}&gt;</span>'.format(tag_style, node.tag)
+        return start_tag_html, end_tag_html
 
-            indent_style = "padding-left: {}px;".format(level * 20)
-            
-            # Tag Attributes
-            attrs = ""
-            for k, v in elem.attrib.items():
-                if not k.startswith('__'):
-                    val = escape_html(v).replace('"', '&quot;')
-                    attrs += ' {}="{}"'.format(k, val)
-            
-            tag = elem.tag
-            diff_style = elem.get('__diff_style__')
-            tag_style = diff_style if diff_style else "color: #6b7280;"
-            
-            start_tag_html = '<span style="{}">&lt;{}{}&gt;</span>'.format(tag_style, tag, attrs)
-            end_tag_html = '<span style="{}">&lt;/{}&gt;</span>'.format(tag_style, tag)
-            
-            # Appended Spacers
-            append_spacer = int(elem.get('__append_spacer__', 0))
-            spacer_html = "".join(['<div class="spacer">&nbsp;</div>' for _ in range(append_spacer)])
+    def write_marked(node, style, level, out, append_spacer):
+        """
+        Writes a removed/added subtree, marking and escaping it on the way,
+        followed by append_spacer blank lines. Explicit-stack walk; closing
+        tags are pushed as plain strings so they come out after the children.
+        """
+        stack = [(node, level)]
+        while stack:
+            item = stack.pop()
+            if type(item) is str:
+                out.append(item)
+                continue
+            elem, level = item
+            indent_style = _indent_style(level)
+            start_tag_html, end_tag_html = tag_html(elem, style)
+
+            text = elem.text
+            wrapped = bool(text and text.strip())
+            if wrapped:
+                text = '<span style="{} font-weight:bold;">{}</span>'.format(style, _escape_html(text))
 
             # Leaf Node (Inline)
             if len(elem) == 0:
-                text = elem.text or ""
-                content_html = text
-                if not content_html.startswith('<span'):
+                content_html = text or ""
+                if not wrapped:
                     content_html = '<span style="color: #374151;">{}</span>'.format(content_html)
-                
-                return '<div style="{}">{}{}{}</div>{}'.format(indent_style, start_tag_html, content_html, end_tag_html, spacer_html)
-            
+                out.append('<div style="{}">{}{}{}</div>'.format(indent_style, start_tag_html, content_html, end_tag_html))
+                continue
+
             # Container Node
-            out = '<div style="{}">{}</div>'.format(indent_style, start_tag_html)
+            out.append('<div style="{}">{}</div>'.format(indent_style, start_tag_html))
+            if wrapped:
+                out.append('<div style="{}">{}</div>'.format(_indent_style(level + 1), text.strip()))
+            stack.append('<div style="{}">{}</div>'.format(indent_style, end_tag_html))
+            stack.extend((child, level + 1) for child in reversed(elem))
+        out.append(_SPACER * append_spacer)
+
+    # 4. Compare and write out the HTML in one pass
+    html_a = []
+    html_b = []
+
+    def start_pair(node_a, node_b, level):
+        """
+        Compares two nodes as far as possible without their children.
+        A settled pair is written to html_a / html_b at once; the result is
+        None when it is unchanged, else its (left, right) height in lines.
+        A same-tag pair gets a slot for its opening tags on each side and
+        is returned as a _Frame; compare_nodes completes it with finish_pair.
+        """
+        # Case 0: Both None
+        if node_a is None and node_b is None:
+            return None
+
+        # Case 1: Removal (A exists, B is None)
+        if node_b is None:
+            stats["removed"] += 1
+            lines = line_counts[node_a]
+            write_marked(node_a, "color:#cc0000;", level, html_a, 0) # Red
+            html_b.append(_SPACER * lines)
+            return (lines, lines)
+
+        # Case 2: Addition (A is None, B exists)
+        if node_a is None:
+            stats["added"] += 1
+            lines = line_counts[node_b]
+            html_a.append(_SPACER * lines)
+            write_marked(node_b, "color:#00aa00;", level, html_b, 0) # Green
+            return (lines, lines)
+
+        # Identical subtrees: nothing to show
+        if node_ids[node_a] == node_ids[node_b]:
+            return None
+
+        # Case 3: Different Tags (treat as remove + add)
+        # Note: With identity key sorting, this rarely happens unless key matched but tag differed?
+        # Actually, key includes tag, so this block might be unreachable via merge-join, 
+        # but safe to keep for root or direct calls.
+        if node_a.tag != node_b.tag:
+            stats["removed"] += 1
+            stats["added"] += 1
+            # Balance lines
+            lines_a = line_counts[node_a]
+            lines_b = line_counts[node_b]
+            max_lines = max(lines_a, lines_b)
             
-            if elem.text and elem.text.strip():
-                text_indent = "padding-left: {}px;".format((level * 20) + 20)
-                text_content = elem.text.strip()
-                if not text_content.startswith('<span'):
-                    text_content = '<span style="color: #374151;">{}</span>'.format(text_content)
-                out += '<div style="{}">{}</div>'.format(text_indent, text_content)
-                
-            for child in elem:
-                out += serialize(child, level + 1)
-                
-            out += '<div style="{}">{}</div>'.format(indent_style, end_tag_html)
-            out += spacer_html
-            return out
+            write_marked(node_a, "color:#cc0000;", level, html_a, max_lines - lines_a)
+            write_marked(node_b, "color:#00aa00;", level, html_b, max_lines - lines_b)
+            # Appended spacers add to the height of containers only
+            return (max_lines if len(node_a) else 1, max_lines if len(node_b) else 1)
+
+        # Case 4: Same Tag - Compare Internals
+        # The opening tags depend on the outcome: hold their place
+        html_a.append(None)
+        html_b.append(None)
+        return _Frame(node_a, node_b, level, len(html_a) - 1, len(html_b) - 1, [], child_pairs(node_a, node_b))
+
+    def child_pairs(node_a, node_b):
+        """
+        Merge-joins the sorted children of two nodes. Yields (A, B) for a
+        match, (A, None) for a removal and (None, B) for an addition.
+        """
+        # Children are already sorted; walk them in place with iterators
+        # rather than copying them into lists (indexing an lxml node walks
+        # its siblings, so iterators are also the cheap way there)
+        iter_a = iter(node_a)
+        iter_b = iter(node_b)
+        c_a = next(iter_a, None)
+        c_b = next(iter_b, None)
+        
+        while c_a is not None or c_b is not None:
+            k_a = identity_keys[c_a] if c_a is not None else None
+            k_b = identity_keys[c_b] if c_b is not None else None
             
-        left_out = serialize(result_left)
-        right_out = serialize(result_right)
+            # Match
+            if k_a == k_b:
+                yield c_a, c_b
+                c_a = next(iter_a, None)
+                c_b = next(iter_b, None)
+            
+            # Removed (A < B or B exhausted)
+            elif c_b is None or (c_a is not None and k_a < k_b):
+                yield c_a, None
+                c_a = next(iter_a, None)
+                
+            # Added (B < A or A exhausted)
+            else:
+                yield None, c_b
+                c_b = next(iter_b, None)
+
+    def write_pair_node(out, slot, node, text, diff_style, level, append_spacer):
+        """
+        Fills in the slot of a same-tag node: inline for a leaf, or as its
+        opening tag (and text line) with the closing tag after the children.
+        """
+        indent_style = _indent_style(level)
+        start_tag_html, end_tag_html = tag_html(node, diff_style if diff_style else "color: #6b7280;")
+        spacer_html = _SPACER * append_spacer
+
+        # Leaf Node (Inline): no changed children were written
+        if len(out) == slot + 1:
+            content_html = text
+            if not diff_style:
+                content_html = '<span style="color: #374151;">{}</span>'.format(content_html)
+            out[slot] = '<div style="{}">{}{}{}</div>{}'.format(indent_style, start_tag_html, content_html, end_tag_html, spacer_html)
+            return
+
+        # Container Node
+        head = '<div style="{}">{}</div>'.format(indent_style, start_tag_html)
+        if text:
+            text_content = text
+            if not diff_style:
+                text_content = '<span style="color: #374151;">{}</span>'.format(text_content)
+            head += '<div style="{}">{}</div>'.format(_indent_style(level + 1), text_content)
+        out[slot] = head
+        out.append('<div style="{}">{}</div>{}'.format(indent_style, end_tag_html, spacer_html))
+
+    def finish_pair(frame):
+        """Completes a same-tag pair once its changed children are written."""
+        node_a, node_b, level, slot_a, slot_b, child_lines, _ = frame
+        text_a = (node_a.text or "").strip()
+        text_b = (node_b.text or "").strip()
+        text_changed = text_a != text_b
 
+        # --- Pruning ---
+        # Only changed children were written
+        if not text_changed and not child_lines:
+            del html_a[slot_a:]
+            del html_b[slot_b:]
+            return None
+
+        # --- Text Content ---
+        if text_changed:
+            stats["modified"] += 1
+            text_a = '<span style="color:#ff8800; font-weight:bold;">{}</span>'.format(_escape_html(text_a))
+            text_b = '<span style="color:#ff8800; font-weight:bold;">{}</span>'.format(_escape_html(text_b))
+            style = 'color:#ff8800;'
+        else:
+            text_a = _escape_html(text_a)
+            text_b = _escape_html(text_b)
+            style = None
+
+        # --- Final Balancing (Crucial for Side-by-Side) ---
+        # Both sides hold the same number of children
+        if child_lines:
+            # Container: OpenTag + (Text?) + Children + CloseTag
+            l_lines = 2 + (1 if text_a else 0) + sum(lines[0] for lines in child_lines)
+            r_lines = 2 + (1 if text_b else 0) + sum(lines[1] for lines in child_lines)
+            lines = max(l_lines, r_lines)
+        else:
+            # Leaf node <tag>val</tag> is 1 line
+            l_lines = r_lines = lines = 1
+
+        write_pair_node(html_a, slot_a, node_a, text_a, style, level, lines - l_lines)
+        write_pair_node(html_b, slot_b, node_b, text_b, style, level, lines - r_lines)
+        return (lines, lines)
+
+    def compare_nodes(node_a, node_b):
+        """
+        Compares two trees with an explicit stack of open _Frames, so deep
+        documents don't run into the recursion limit. Returns whether they
+        differ.
+        """
+        stack = []
+        res = start_pair(node_a, node_b, 0)
+        while True:
+            if type(res) is _Frame:
+                stack.append(res)
+            elif not stack:
+                return res is not None
+            elif res is not None:
+                # Unchanged children are pruned from the output
+                stack[-1].child_lines.append(res)
+
+            frame = stack[-1]
+            pair = next(frame.pairs, None)
+            if pair is None:
+                stack.pop()
+                res = finish_pair(frame)
+            else:
+                res = start_pair(pair[0], pair[1], frame.level + 1)
+
+    # Start Comparison
+    any_change = compare_nodes(root_before, root_after)
+    left_out = "".join(html_a)
+    right_out = "".join(html_b)
+
+    return {
+        "left": left_out if left_out else _NO_CHANGES,
+        "right": right_out if right_out else _NO_CHANGES,
+        "metadata": {
+            "changed": any_change,
+            "added_count": stats["added"],
+            "removed_count": stats["removed"],
+            "changed_count": stats["modified"]
+        }
+    }
+
+class FilterModule(object):
+    def filters(self):
         return {
-            "left": left_out if left_out else '<div class="text-gray-400 italic p-4">No Changes</div>',
-            "right": right_out if right_out else '<div class="text-gray-400 italic p-4">No Changes</div>',
-            "metadata": {
-                "changed": any_change,
-                "added_count": self.stats["added"],
-                "removed_count": self.stats["removed"],
-                "changed_count": self.stats["modified"]
-            }
+            'xml_struct_diff': self.xml_struct_diff
+        }
+
+    def xml_struct_diff(self, before_xml, after_xml):
+        """
+        Compares two XML strings (Before vs After) using a structural merge-join strategy.
+        1. Normalizes and removes namespaces.
+        2. Canonically sorts elements based on "Identity Keys" (Tags + specific ID children like <name>, <id>).
+        3. Compares trees using a merge-join algorithm to correctly handle insertions/removals in lists.
+        4. Generates HTML-ready output with inline styles and spacer blocks for synchronized scrolling.
+        """
+        result = _struct_diff(before_xml, after_xml)
+        metadata = result["metadata"]
+        self.stats = {
+            "added": metadata["added_count"],
+            "removed": metadata["removed_count"],
+            "modified": metadata["changed_count"]
         }
+        # Callers get their own dicts so the cached result can't be changed
+        return dict(result, metadata=dict(metadata))
@@ -5,324 +5,397 @@ from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
 import re
-import xml.etree.ElementTree as ET
-import difflib
-from copy import deepcopy
+from sys import intern
+from functools import lru_cache
+from collections import namedtuple
 
-class FilterModule(object):
-    def filters(self):
+# lxml parses in C; the Element API used below is the same in both
+try:
+    from lxml import etree as ET
+    # Comments and PIs are dropped and internal entities expanded as
+    # ElementTree does (external ones never are), and the text is handed
+    # over as UTF-8 bytes so an encoding declaration in the document is
+    # ignored
+    _PARSER = ET.XMLParser(
+        remove_blank_text=True,
+        remove_comments=True,
+        remove_pis=True,
+        resolve_entities='internal',
+        huge_tree=True,
+        encoding='utf-8',
+    )
+except ImportError:
+    import xml.etree.ElementTree as ET
+    _PARSER = None
+
+def _fromstring(text):
+    if _PARSER is None:
+        return ET.fromstring(text)
+    return ET.fromstring(text.encode('utf-8'), _PARSER)
+
+# Default and prefixed namespace declarations, stripped in a single scan
+_NS_RE = re.compile(r' xmlns(?::[a-z0-9]+)?="[^"]+"')
+
+# One blank line of a spacer block
+_SPACER = '<div class="spacer">&nbsp;</div>'
+
+_HTML_ESCAPE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+# Attribute values also need their quotes escaped
+_ATTR_ESCAPE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;"})
+
+# Helpers for HTML escaping, one translate pass each
+def _escape_html(s):
+    if not s: return ""
+    return s.translate(_HTML_ESCAPE)
+
+def _escape_attr(s):
+    if not s: return ""
+    return s.translate(_ATTR_ESCAPE)
+
+# Shown on a side that has nothing to report
+_NO_CHANGES = '<div class="text-gray-400 italic p-4">No Changes</div>'
+
+# A same-tag pair whose children are still being compared. slot_a and
+# slot_b hold the place of its opening tags in the HTML, pairs yields the
+# next child pair
+_Frame = namedtuple('_Frame', 'node_a node_b level slot_a slot_b pairs')
+
+# Indent styles per nesting level, built once
+_INDENT_STYLES = ["padding-left: {}px;".format(i * 20) for i in range(64)]
+
+def _indent_style(level):
+    if level < len(_INDENT_STYLES):
+        return _INDENT_STYLES[level]
+    return "padding-left: {}px;".format(level * 20)
+
+# The diff engine is a pure function of the two input strings. Playbooks
+# often run the filter again on the same payloads for every host, so the
+# most recent results are kept. Each entry holds both input strings and
+# both reports, hence the small size
+@lru_cache(maxsize=16)
+def _struct_diff(before_xml, after_xml):
+    # Identical inputs cannot differ: skip parsing, sorting and diffing
+    if before_xml == after_xml:
         return {
-            'xml_struct_diff': self.xml_struct_diff
+            "left": _NO_CHANGES,
+            "right": _NO_CHANGES,
+            "metadata": {
+                "changed": False,
+                "added_count": 0,
+                "removed_count": 0,
+                "changed_count": 0
+            }
         }
+    
+    # Deep key of every parsed node, for aligning children by merge-join,
+    # and its rendered line count, for spacers.
+    # Kept in dicts: Elements don't take extra Python attributes
+    sort_keys = {}
+    line_counts = {}
+    # Structural ids, shared by both documents: equal ids mean equal deep
+    # keys. Equality tests use them, so nested key tuples are only ever
+    # compared for order, which for deep documents would recurse per level
+    node_ids = {}
+    shape_ids = {}
 
-    def xml_struct_diff(self, before_xml, after_xml):
-        """
-        Compares two XML strings (Before vs After) and returns a structured diff
-        preserving parent hierarchy with inline styling for reporting.
-        Unchanged subtrees are pruned from the output.
-        Ignores moved elements by canonically sorting the XML tree deeply.
-        """
-        
-        # Helper for HTML escaping
-        def escape_html(s):
-            if not s: return ""
-            return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-
-        # Recursive Sorter & Key Generator
-        # Sorts the tree in-place and attaches a _sort_key to each node for alignment
-        def sort_and_key(node):
-            # 1. Recursively sort children and get their keys
-            child_keys = []
-            for child in node:
-                child_keys.append(sort_and_key(child))
-            
-            # 2. Sort current node's children based on their keys
-            # Zip nodes with keys to sort together
-            if child_keys:
-                children_with_keys = sorted(zip(node, child_keys), key=lambda x: x[1])
-                # Apply sorted order to children
-                node[:] = [x[0] for x in children_with_keys]
-                # Extract the sorted child keys for this node's key calculation
-                my_sorted_child_keys = tuple(x[1] for x in children_with_keys)
+    # Sorter & Key Generator
+    # Sorts the tree in-place, bottom-up with an explicit stack, so that
+    # every child is sorted, keyed and counted before its parent
+    def sort_and_key(root):
+        stack = [(root, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if not children_done:
+                stack.append((node, True))
+                stack.extend((child, False) for child in node)
+                continue
+
+            # 1. Sort current node's children based on their keys
+            if len(node):
+                node[:] = sorted(node, key=sort_keys.__getitem__)
+                my_sorted_child_keys = tuple(sort_keys[c] for c in node)
+                # Open tag (1) + Text content (0 or 1) + Children + Close tag (1)
+                lines = 2 + sum(line_counts[c] for c in node)
+                if node.text and node.text.strip():
+                    lines += 1
             else:
                 my_sorted_child_keys = ()
+                lines = 1 # <tag>value</tag> is 1 line
+            line_counts[node] = lines
 
-            # 3. Generate Deep Key for this node
+            # 2. Generate Deep Key for this node
             # Key = (Tag, Attributes, Text, ChildrenKeys)
-            my_key = (
-                node.tag, 
-                tuple(sorted(node.attrib.items())), 
-                (node.text or "").strip(),
+            # Strings are interned: the same tags and values recur across
+            # both documents, and equal parts then compare by identity
+            key = sort_keys[node] = (
+                intern(node.tag), 
+                tuple((intern(k), intern(v)) for k, v in sorted(node.attrib.items())), 
+                intern((node.text or "").strip()),
                 my_sorted_child_keys
             )
-            
-            # Attach key to node object for use in SequenceMatcher
-            node._sort_key = my_key
-            return my_key
-
-        # 1. Normalize and Parse
-        def parse_clean(xml_str):
-            if not xml_str or not xml_str.strip():
-                return None
-            # Remove namespaces
-            clean_xml = re.sub(r' xmlns="[^"]+"', '', xml_str, count=0)
-            clean_xml = re.sub(r' xmlns:[a-z0-9]+="[^"]+"', '', clean_xml, count=0)
-            try:
-                root = ET.fromstring(clean_xml)
-                sort_and_key(root)
-                return root
-            except ET.ParseError:
-                return None
-
-        root_before = parse_clean(before_xml)
-        root_after = parse_clean(after_xml)
-
-        # Counters
-        self.stats = {
-            "added": 0,
-            "removed": 0,
-            "modified": 0
-        }
+            shape = key[:3] + (tuple(node_ids[c] for c in node),)
+            node_ids[node] = shape_ids.setdefault(shape, len(shape_ids))
 
-        # Helper to calculate rendered line count for spacers
-        def count_lines(elem, is_leaf=False):
-            if elem is None: return 0
-            if is_leaf: return 1 # <tag>value</tag> is 1 line
-            
-            # Open tag (1) + Text content (0 or 1) + Children + Close tag (1)
-            lines = 2 
-            if elem.text and elem.text.strip():
-                lines += 1
-            for child in elem:
-                # Check if child is leaf
-                child_is_leaf = (len(child) == 0)
-                lines += count_lines(child, child_is_leaf)
-            return lines
-
-        # 2. Recursive Comparison
-        def compare_nodes(node_a, node_b):
-            if node_a is None and node_b is None:
-                return (None, None, False)
-
-            # Node Removed
-            if node_b is None:
-                self.stats["removed"] += 1
-                res_a = deepcopy(node_a)
-                mark_tree(res_a, "color:#cc0000;") # Red
-                lines = count_lines(res_a, len(res_a) == 0)
-                res_b_spacer = ET.Element("__spacer__", lines=str(lines))
-                return (res_a, res_b_spacer, True)
-
-            # Node Added
-            if node_a is None:
-                self.stats["added"] += 1
-                res_b = deepcopy(node_b)
-                mark_tree(res_b, "color:#00aa00;") # Green
-                lines = count_lines(res_b, len(res_b) == 0)
-                res_a_spacer = ET.Element("__spacer__", lines=str(lines))
-                return (res_a_spacer, res_b, True)
-
-            # Compare Tags (Since we sorted, mismatch usually means total difference)
-            if node_a.tag != node_b.tag:
-                self.stats["removed"] += 1
-                self.stats["added"] += 1
-                res_a = deepcopy(node_a)
-                res_b = deepcopy(node_b)
-                mark_tree(res_a, "color:#cc0000;")
-                mark_tree(res_b, "color:#00aa00;")
-                
-                lines_a = count_lines(res_a, len(res_a)==0)
-                lines_b = count_lines(res_b, len(res_b)==0)
-                
-                if lines_a < lines_b:
-                    res_a.set('__append_spacer__', str(lines_b - lines_a))
-                elif lines_b < lines_a:
-                    res_b.set('__append_spacer__', str(lines_a - lines_b))
-                    
-                return (res_a, res_b, True)
-
-            # Compare Attributes & Text
-            text_a = (node_a.text or "").strip()
-            text_b = (node_b.text or "").strip()
-            is_modified = text_a != text_b
-            
-            if node_a.attrib != node_b.attrib:
-                is_modified = True
+    # 1. Normalize and Parse
+    def parse_clean(xml_str):
+        if not xml_str or not xml_str.strip():
+            return None
+        # Remove namespaces
+        clean_xml = _NS_RE.sub('', xml_str)
+        try:
+            root = _fromstring(clean_xml)
+            sort_and_key(root)
+            return root
+        except ET.ParseError:
+            return None
 
-            out_a = ET.Element(node_a.tag, attrib=node_a.attrib)
-            out_b = ET.Element(node_b.tag, attrib=node_b.attrib)
-            
-            children_a = list(node_a)
-            children_b = list(node_b)
-            
-            # --- Sequence Matcher for Intelligent Alignment ---
-            # Retrieve keys generated during sort
-            keys_a = [getattr(c, '_sort_key', None) for c in children_a]
-            keys_b = [getattr(c, '_sort_key', None) for c in children_b]
-
-            matcher = difflib.SequenceMatcher(None, keys_a, keys_b)
-            has_child_changes = False
-
-            for tag, i1, i2, j1, j2 in matcher.get_opcodes():
-                if tag == 'equal':
-                    # Nodes match exactly. Recurse to potentially copy or prune.
-                    # Even if equal, we run compare_nodes to handle the structure.
-                    for k in range(i2 - i1):
-                        c_a = children_a[i1 + k]
-                        c_b = children_b[j1 + k]
-                        child_res_a, child_res_b, changed = compare_nodes(c_a, c_b)
-                        if changed:
-                            has_child_changes = True
-                            out_a.append(child_res_a)
-                            out_b.append(child_res_b)
-                            
-                elif tag == 'replace':
-                    # Block mismatch. Try to align by Tag to show modification vs add/remove.
-                    # We iterate through the mismatch block.
-                    len_a = i2 - i1
-                    len_b = j2 - j1
-                    min_len = min(len_a, len_b)
-                    
-                    for k in range(min_len):
-                        c_a = children_a[i1 + k]
-                        c_b = children_b[j1 + k]
-                        
-                        # Heuristic: If tags match, treat as Modified
-                        if c_a.tag == c_b.tag:
-                            child_res_a, child_res_b, changed = compare_nodes(c_a, c_b)
-                            if changed:
-                                has_child_changes = True
-                                out_a.append(child_res_a)
-                                out_b.append(child_res_b)
-                        else:
-                            # Tags differ: Remove A, Add B
-                            child_res_a, _, _ = compare_nodes(c_a, None)
-                            _, child_res_b, _ = compare_nodes(None, c_b)
-                            has_child_changes = True
-                            out_a.append(child_res_a)
-                            out_b.append(child_res_b)
-                    
-                    # Handle Leftovers
-                    if len_a > len_b: # More in A -> Removed
-                        for k in range(min_len, len_a):
-                            c_a = children_a[i1 + k]
-                            # compare_nodes(A, None) returns (A_marked, Spacer, True)
-                            res_a, res_b_spacer, _ = compare_nodes(c_a, None)
-                            has_child_changes = True
-                            out_a.append(res_a)
-                            out_b.append(res_b_spacer)
-                    elif len_b > len_a: # More in B -> Added
-                        for k in range(min_len, len_b):
-                            c_b = children_b[j1 + k]
-                            res_a_spacer, res_b, _ = compare_nodes(None, c_b)
-                            has_child_changes = True
-                            out_a.append(res_a_spacer)
-                            out_b.append(res_b)
-                
-                elif tag == 'delete':
-                    for k in range(i1, i2):
-                        c_a = children_a[k]
-                        res_a, res_b_spacer, _ = compare_nodes(c_a, None)
-                        has_child_changes = True
-                        out_a.append(res_a)
-                        out_b.append(res_b_spacer)
-                
-                elif tag == 'insert':
-                    for k in range(j1, j2):
-                        c_b = children_b[k]
-                        res_a_spacer, res_b, _ = compare_nodes(None, c_b)
-                        has_child_changes = True
-                        out_a.append(res_a_spacer)
-                        out_b.append(res_b)
-
-            # Text content check
-            if is_modified:
-                self.stats["modified"] += 1
-                # Mark text specifically. Escape first, then wrap.
-                out_a.text = '<span style="color:#ff8800; font-weight:bold;">{}</span>'.format(escape_html(text_a))
-                out_b.text = '<span style="color:#ff8800; font-weight:bold;">{}</span>'.format(escape_html(text_b))
-                out_a.set('__diff_style__', 'color:#ff8800;') 
-                out_b.set('__diff_style__', 'color:#ff8800;')
-            else:
-                out_a.text = escape_html(text_a)
-                out_b.text = escape_html(text_b)
-            
-            # PRUNING: If no text change and no child changes, return Nothing
-            if not is_modified and not has_child_changes:
-                return (None, None, False)
-                
-            return (out_a, out_b, True)
-
-        def mark_tree(element, style):
-            if element is None: return
-            if element.text and element.text.strip():
-                element.text = '<span style="{} font-weight:bold;">{}</span>'.format(style, escape_html(element.text))
-            
-            element.set('__diff_style__', style)
-            for child in element:
-                mark_tree(child, style)
+    root_before = parse_clean(before_xml)
+    root_after = parse_clean(after_xml)
 
-        result_left, result_right, any_change = compare_nodes(root_before, root_after)
+    # Counters
+    stats = {
+        "added": 0,
+        "removed": 0,
+        "modified": 0
+    }
 
-        # 3. Custom Serializer (Same as before)
-        def serialize(elem, level=0):
-            if elem is None: return ""
-            
-            if elem.tag == "__spacer__":
-                lines = int(elem.get('lines', 1))
-                return "".join(['<div class="spacer">&nbsp;</div>' for _ in range(lines)])
+    # Tag spans of a node in the given style
+    def tag_html(node, tag_style):
+        attrs = "".join(
+            ' {}="{}"'.format(k, _escape_attr(v))
+            for k, v in node.attrib.items()
+        )
+        start_tag_html = '<span style="{}">&lt;{}{}&gt;</span>'.format(tag_style, node.tag, attrs)
+        end_tag_html = '<span style="{}">&lt;/{}&gt;</span>'.format(tag_style, node.tag)
+        return start_tag_html, end_tag_html
 
-            indent_style = "padding-left: {}px;".format(level * 20)
-            
-            attrs = ""
-            for k, v in elem.attrib.items():
-                if not k.startswith('__'):
-                    val = escape_html(v).replace('"', '&quot;')
-                    attrs += ' {}="{}"'.format(k, val)
-            
-            tag = elem.tag
-            diff_style = elem.get('__diff_style__')
-            tag_style = diff_style if diff_style else "color: #6b7280;"
-            
-            start_tag_html = '<span style="{}">&lt;{}{}&gt;</span>'.format(tag_style, tag, attrs)
-            end_tag_html = '<span style="{}">&lt;/{}&gt;</span>'.format(tag_style, tag)
-            
-            append_spacer = int(elem.get('__append_spacer__', 0))
-            spacer_html = "".join(['<div class="spacer">&nbsp;</div>' for _ in range(append_spacer)])
+    # Writes a removed/added subtree, marking and escaping it on the way.
+    # Explicit-stack walk; closing tags are pushed as plain strings so they
+    # come out after the children. append_spacer pads the block to its
+    # peer's height
+    def write_marked(node, style, level, out, append_spacer):
+        stack = [(node, level)]
+        while stack:
+            item = stack.pop()
+            if type(item) is str:
+                out.append(item)
+                continue
+            elem, level = item
+            indent_style = _indent_style(level)
+            start_tag_html, end_tag_html = tag_html(elem, style)
+
+            text = elem.text
+            wrapped = bool(text and text.strip())
+            if wrapped:
+                text = '<span style="{} font-weight:bold;">{}</span>'.format(style, _escape_html(text))
 
             if len(elem) == 0:
-                text = elem.text or ""
-                content_html = text
-                if not content_html.startswith('<span'):
+                content_html = text or ""
+                if not wrapped:
                     content_html = '<span style="color: #374151;">{}</span>'.format(content_html)
-                return '<div style="{}">{}{}{}</div>{}'.format(indent_style, start_tag_html, content_html, end_tag_html, spacer_html)
-            
-            out = '<div style="{}">{}</div>'.format(indent_style, start_tag_html)
-            
-            if elem.text and elem.text.strip():
-                text_indent = "padding-left: {}px;".format((level * 20) + 20)
-                text_content = elem.text.strip()
-                if not text_content.startswith('<span'):
-                    text_content = '<span style="color: #374151;">{}</span>'.format(text_content)
-                out += '<div style="{}">{}</div>'.format(text_indent, text_content)
-                
-            for child in elem:
-                out += serialize(child, level + 1)
-                
-            out += '<div style="{}">{}</div>'.format(indent_style, end_tag_html)
-            out += spacer_html
-            return out
+                out.append('<div style="{}">{}{}{}</div>'.format(indent_style, start_tag_html, content_html, end_tag_html))
+                continue
+
+            out.append('<div style="{}">{}</div>'.format(indent_style, start_tag_html))
+            if wrapped:
+                out.append('<div style="{}">{}</div>'.format(_indent_style(level + 1), text.strip()))
+            stack.append('<div style="{}">{}</div>'.format(indent_style, end_tag_html))
+            stack.extend((child, level + 1) for child in reversed(elem))
+        out.append(_SPACER * append_spacer)
+
+    # 2. Comparison, written straight out as HTML
+    # Both sides are rendered into html_a / html_b while comparing. A pair
+    # either settles at once (start_pair writes it and returns whether it
+    # changed) or opens a _Frame whose children are compared before
+    # finish_pair completes it. Frames live on an explicit stack, so deep
+    # documents don't run into the recursion limit
+    html_a = []
+    html_b = []
+
+    def start_pair(node_a, node_b, level):
+        if node_a is None and node_b is None:
+            return False
+
+        # Node Removed
+        if node_b is None:
+            stats["removed"] += 1
+            write_marked(node_a, "color:#cc0000;", level, html_a, 0) # Red
+            html_b.append(_SPACER * line_counts[node_a])
+            return True
+
+        # Node Added
+        if node_a is None:
+            stats["added"] += 1
+            html_a.append(_SPACER * line_counts[node_b])
+            write_marked(node_b, "color:#00aa00;", level, html_b, 0) # Green
+            return True
+
+        # Equal ids mean identical subtrees: nothing to show
+        if node_ids[node_a] == node_ids[node_b]:
+            return False
+
+        # Compare Tags (Since we sorted, mismatch usually means total difference)
+        if node_a.tag != node_b.tag:
+            stats["removed"] += 1
+            stats["added"] += 1
+            lines_a = line_counts[node_a]
+            lines_b = line_counts[node_b]
             
-        left_out = serialize(result_left)
-        right_out = serialize(result_right)
+            write_marked(node_a, "color:#cc0000;", level, html_a, max(lines_b - lines_a, 0))
+            write_marked(node_b, "color:#00aa00;", level, html_b, max(lines_a - lines_b, 0))
+            return True
+
+        # The opening tags are only known once the children are compared:
+        # keep a slot for each, to be filled in by finish_pair
+        html_a.append(None)
+        html_b.append(None)
+        return _Frame(node_a, node_b, level, len(html_a) - 1, len(html_b) - 1, child_pairs(node_a, node_b))
+
+    # --- Merge-Join for Intelligent Alignment ---
+    # Children are sorted by their deep keys (generated during sort),
+    # so one linear pass aligns the two lists. They are walked in place
+    # with iterators rather than copied into lists (indexing an lxml
+    # node walks its siblings, so iterators are also the cheap way there).
+    # Yields (A, B), (A, None) for Removed and (None, B) for Added
+    def child_pairs(node_a, node_b):
+        # Subtrees found on one side only. Two same-tagged children of that
+        # kind are shown as a modification instead of remove + add
+        set_a = {node_ids[c] for c in node_a}
+        set_b = {node_ids[c] for c in node_b}
+
+        iter_a = iter(node_a)
+        iter_b = iter(node_b)
+        next_a = next(iter_a, None)
+        next_b = next(iter_b, None)
+
+        while next_a is not None or next_b is not None:
+            if next_b is None: # B exhausted -> Removed
+                c_a, c_b = next_a, None
+            elif next_a is None: # A exhausted -> Added
+                c_a, c_b = None, next_b
+            else:
+                id_a = node_ids[next_a]
+                id_b = node_ids[next_b]
+                if id_a == id_b or (next_a.tag == next_b.tag and id_a not in set_b and id_b not in set_a):
+                    # Match or Modified
+                    c_a, c_b = next_a, next_b
+                elif sort_keys[next_a] < sort_keys[next_b]: # Removed
+                    c_a, c_b = next_a, None
+                else: # Added
+                    c_a, c_b = None, next_b
+            if c_a is not None:
+                next_a = next(iter_a, None)
+            if c_b is not None:
+                next_b = next(iter_b, None)
+            yield c_a, c_b
+
+    # Fills in a pair node's slot: inline for a leaf, or as an opening tag
+    # (plus text line) with the closing tag after its children
+    def write_pair_node(out, slot, node, text, diff_style, level):
+        indent_style = _indent_style(level)
+        start_tag_html, end_tag_html = tag_html(node, diff_style if diff_style else "color: #6b7280;")
+
+        if len(out) == slot + 1: # No changed children
+            content_html = text
+            if not diff_style:
+                content_html = '<span style="color: #374151;">{}</span>'.format(content_html)
+            out[slot] = '<div style="{}">{}{}{}</div>'.format(indent_style, start_tag_html, content_html, end_tag_html)
+            return
+
+        head = '<div style="{}">{}</div>'.format(indent_style, start_tag_html)
+        if text:
+            text_content = text
+            if not diff_style:
+                text_content = '<span style="color: #374151;">{}</span>'.format(text_content)
+            head += '<div style="{}">{}</div>'.format(_indent_style(level + 1), text_content)
+        out[slot] = head
+        out.append('<div style="{}">{}</div>'.format(indent_style, end_tag_html))
+
+    def finish_pair(frame):
+        node_a, node_b, level, slot_a, slot_b, _ = frame
+
+        # Compare Attributes & Text
+        text_a = (node_a.text or "").strip()
+        text_b = (node_b.text or "").strip()
+        is_modified = text_a != text_b
+        
+        if node_a.attrib != node_b.attrib:
+            is_modified = True
+
+        # PRUNING: If no text change and no child changes, drop the slots
+        # (unchanged children write nothing)
+        if not is_modified and len(html_a) == slot_a + 1:
+            del html_a[slot_a:]
+            del html_b[slot_b:]
+            return False
+
+        # Text content check
+        if is_modified:
+            stats["modified"] += 1
+            # Mark text specifically. Escape first, then wrap.
+            text_a = '<span style="color:#ff8800; font-weight:bold;">{}</span>'.format(_escape_html(text_a))
+            text_b = '<span style="color:#ff8800; font-weight:bold;">{}</span>'.format(_escape_html(text_b))
+            style = 'color:#ff8800;'
+        else:
+            text_a = _escape_html(text_a)
+            text_b = _escape_html(text_b)
+            style = None
+
+        write_pair_node(html_a, slot_a, node_a, text_a, style, level)
+        write_pair_node(html_b, slot_b, node_b, text_b, style, level)
+        return True
 
+    def compare_nodes(node_a, node_b):
+        stack = []
+        res = start_pair(node_a, node_b, 0)
+        while True:
+            if type(res) is _Frame:
+                stack.append(res)
+            elif not stack:
+                return res
+
+            frame = stack[-1]
+            pair = next(frame.pairs, None)
+            if pair is None:
+                stack.pop()
+                res = finish_pair(frame)
+            else:
+                res = start_pair(pair[0], pair[1], frame.level + 1)
+
+    any_change = compare_nodes(root_before, root_after)
+    left_out = "".join(html_a)
+    right_out = "".join(html_b)
+
+    return {
+        "left": left_out if left_out else _NO_CHANGES,
+        "right": right_out if right_out else _NO_CHANGES,
+        "metadata": {
+            "changed": any_change,
+            "added_count": stats["added"],
+            "removed_count": stats["removed"],
+            "changed_count": stats["modified"]
+        }
+    }
+
+class FilterModule(object):
+    def filters(self):
         return {
-            "left": left_out if left_out else '<div class="text-gray-400 italic p-4">No Changes</div>',
-            "right": right_out if right_out else '<div class="text-gray-400 italic p-4">No Changes</div>',
-            "metadata": {
-                "changed": any_change,
-                "added_count": self.stats["added"],
-                "removed_count": self.stats["removed"],
-                "changed_count": self.stats["modified"]
-            }
+            'xml_struct_diff': self.xml_struct_diff
+        }
+
+    def xml_struct_diff(self, before_xml, after_xml):
+        """
+        Compares two XML strings (Before vs After) and returns a structured diff
+        preserving parent hierarchy with inline styling for reporting.
+        Unchanged subtrees are pruned from the output.
+        Ignores moved elements by canonically sorting the XML tree deeply.
+        """
+        result = _struct_diff(before_xml, after_xml)
+        metadata = result["metadata"]
+        self.stats = {
+            "added": metadata["added_count"],
+            "removed": metadata["removed_count"],
+            "modified": metadata["changed_count"]
         }
+        # Callers get their own dicts so the cached result can't be changed
+        return dict(result, metadata=dict(metadata))
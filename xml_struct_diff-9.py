@@ -4,10 +4,45 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
-import re
-import xml.etree.ElementTree as ET
 import difflib
-from copy import deepcopy
+from functools import lru_cache
+
+# lxml parses in C; the Element API used below is the same in both
+try:
+    from lxml import etree as ET
+    # Comments and PIs are dropped and internal entities expanded as
+    # ElementTree does (external ones never are), and the text is handed
+    # over as UTF-8 bytes so an encoding declaration in the document is
+    # ignored
+    _PARSE_OPTIONS = dict(
+        remove_blank_text=True,
+        remove_comments=True,
+        remove_pis=True,
+        resolve_entities='internal',
+        huge_tree=True,
+        encoding='utf-8',
+    )
+except ImportError:
+    import xml.etree.ElementTree as ET
+    _PARSE_OPTIONS = None
+
+# Parses a document with the options above, whichever parser is in use
+def _fromstring(text):
+    if _PARSE_OPTIONS is None:
+        return ET.fromstring(text)
+    return ET.fromstring(text.encode('utf-8'), ET.XMLParser(**_PARSE_OPTIONS))
+
+_HTML_ESCAPE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
+# Div styles per nesting level, built once
+_INDENT_STYLES = ['padding-left: {}px;'.format(i * 20) for i in range(128)]
+_PLAIN_STYLES = [style + ' color: #6b7280;' for style in _INDENT_STYLES]
+
+def _div_style(level, plain=False):
+    if level < len(_INDENT_STYLES):
+        return _PLAIN_STYLES[level] if plain else _INDENT_STYLES[level]
+    style = 'padding-left: {}px;'.format(level * 20)
+    return style + ' color: #6b7280;' if plain else style
 
 class FilterModule(object):
     def filters(self):
@@ -23,56 +58,74 @@ class FilterModule(object):
         Ignores moved elements by canonically sorting the XML tree deeply.
         """
         
-        # Helper for HTML escaping
+        # Helper for HTML escaping; one translate pass, memoized per diff
+        # since the same tag texts recur many times
+        @lru_cache(maxsize=4096)
         def escape_html(s):
             if not s: return ""
-            return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+            return s.translate(_HTML_ESCAPE)
 
         # Global storage for sort keys to avoid attaching attributes to Elements
         # Keys are stored by object identity of the Element
         node_keys = {}
+        # Subtree line counts, filled in by the same pass
+        node_lines = {}
 
-        # Recursive Sorter & Key Generator
+        # Sorter & Key Generator
         # Sorts the tree in-place and generates a key for alignment
-        def sort_and_key(node):
-            # 1. Recursively sort children and get their keys
-            child_keys = []
-            for child in node:
-                child_keys.append(sort_and_key(child))
-            
-            # 2. Sort current node's children based on their keys
-            # Zip nodes with keys to sort together
-            if child_keys:
-                children_with_keys = sorted(zip(node, child_keys), key=lambda x: x[1])
-                # Apply sorted order to children in-place
-                node[:] = [x[0] for x in children_with_keys]
-                # Extract the sorted child keys for this node's key calculation
-                my_sorted_child_keys = tuple(x[1] for x in children_with_keys)
-            else:
-                my_sorted_child_keys = ()
-
-            # 3. Generate Deep Key for this node
-            # Key = (Tag, Attributes, Text, ChildrenKeys)
-            my_key = (
-                node.tag, 
-                tuple(sorted(node.attrib.items())), 
-                (node.text or "").strip(),
-                my_sorted_child_keys
-            )
-            
-            # Store key in dictionary instead of attribute
-            node_keys[node] = my_key
-            return my_key
+        def sort_and_key(root):
+            # Iterative post-order: every child is keyed (and its own
+            # children sorted) before its parent, without a Python frame
+            # per level
+            stack = [(root, False)]
+            while stack:
+                node, children_done = stack.pop()
+                if not children_done:
+                    stack.append((node, True))
+                    stack.extend((child, False) for child in node)
+                    continue
+
+                # Sort children on their keys and apply the order in-place
+                if len(node):
+                    children = list(node)
+                    child_keys = [node_keys[c] for c in children]
+                    order = sorted(range(len(children)), key=child_keys.__getitem__)
+                    node[:] = [children[i] for i in order]
+                    my_sorted_child_keys = tuple(child_keys[i] for i in order)
+                else:
+                    my_sorted_child_keys = ()
+
+                # Namespaces are ignored: compare on local names only
+                if node.tag[0] == '{':
+                    node.tag = node.tag.split('}', 1)[1]
+                attrib = node.attrib
+                for name in [k for k in attrib.keys() if k[0] == '{']:
+                    attrib[name.split('}', 1)[1]] = attrib.pop(name)
+
+                text = (node.text or "").strip()
+
+                # Key = (Tag, Attributes, Text, ChildrenKeys)
+                node_keys[node] = (
+                    node.tag,
+                    tuple(sorted(node.attrib.items())),
+                    text,
+                    my_sorted_child_keys
+                )
+
+                # Rendered height when shown as a container: open + close
+                # tags, a text line, 1 per leaf child, nested containers
+                lines = 3 if text else 2
+                for c in node:
+                    lines += node_lines[c] if len(c) else 1
+                node_lines[node] = lines
+            return node_keys[root]
 
         # 1. Normalize and Parse
         def parse_clean(xml_str):
             if not xml_str or not xml_str.strip():
                 return None
-            # Remove namespaces
-            clean_xml = re.sub(r' xmlns="[^"]+"', '', xml_str, count=0)
-            clean_xml = re.sub(r' xmlns:[a-z0-9]+="[^"]+"', '', clean_xml, count=0)
             try:
-                root = ET.fromstring(clean_xml)
+                root = _fromstring(xml_str)
                 sort_and_key(root)
                 return root
             except ET.ParseError:
@@ -89,19 +142,12 @@ class FilterModule(object):
         }
 
         # Helper to calculate rendered line count for spacers
+        # Line counts come from the parse-time pass, so callers pass the
+        # source node rather than its marked placeholder
         def count_lines(elem, is_leaf=False):
             if elem is None: return 0
             if is_leaf: return 1 # <tag>value</tag> is 1 line
-            
-            # Open tag (1) + Text content (0 or 1) + Children + Close tag (1)
-            lines = 2 
-            if elem.text and elem.text.strip():
-                lines += 1
-            for child in elem:
-                # Check if child is leaf
-                child_is_leaf = (len(child) == 0)
-                lines += count_lines(child, child_is_leaf)
-            return lines
+            return node_lines[elem]
 
         # 2. Recursive Comparison
         def compare_nodes(node_a, node_b):
@@ -111,18 +157,16 @@ class FilterModule(object):
             # Node Removed
             if node_b is None:
                 self.stats["removed"] += 1
-                res_a = deepcopy(node_a)
-                mark_tree(res_a, "color:#cc0000;") # Red
-                lines = count_lines(res_a, len(res_a) == 0)
+                res_a = marked(node_a, "color:#cc0000;") # Red
+                lines = count_lines(node_a, len(node_a) == 0)
                 res_b_spacer = ET.Element("__spacer__", lines=str(lines))
                 return (res_a, res_b_spacer, True)
 
             # Node Added
             if node_a is None:
                 self.stats["added"] += 1
-                res_b = deepcopy(node_b)
-                mark_tree(res_b, "color:#00aa00;") # Green
-                lines = count_lines(res_b, len(res_b) == 0)
+                res_b = marked(node_b, "color:#00aa00;") # Green
+                lines = count_lines(node_b, len(node_b) == 0)
                 res_a_spacer = ET.Element("__spacer__", lines=str(lines))
                 return (res_a_spacer, res_b, True)
 
@@ -130,13 +174,11 @@ class FilterModule(object):
             if node_a.tag != node_b.tag:
                 self.stats["removed"] += 1
                 self.stats["added"] += 1
-                res_a = deepcopy(node_a)
-                res_b = deepcopy(node_b)
-                mark_tree(res_a, "color:#cc0000;")
-                mark_tree(res_b, "color:#00aa00;")
+                res_a = marked(node_a, "color:#cc0000;")
+                res_b = marked(node_b, "color:#00aa00;")
                 
-                lines_a = count_lines(res_a, len(res_a)==0)
-                lines_b = count_lines(res_b, len(res_b)==0)
+                lines_a = count_lines(node_a, len(node_a) == 0)
+                lines_b = count_lines(node_b, len(node_b) == 0)
                 
                 if lines_a < lines_b:
                     res_a.set('__append_spacer__', str(lines_b - lines_a))
@@ -145,6 +187,10 @@ class FilterModule(object):
                     
                 return (res_a, res_b, True)
 
+            # Identical subtrees (same recursive key) have nothing to show
+            if node_keys[node_a] == node_keys[node_b]:
+                return (None, None, False)
+
             # Compare Attributes & Text
             text_a = (node_a.text or "").strip()
             text_b = (node_b.text or "").strip()
@@ -161,8 +207,10 @@ class FilterModule(object):
             
             # --- Sequence Matcher for Intelligent Alignment ---
             # Retrieve keys generated during sort from dictionary
-            keys_a = [node_keys.get(c) for c in children_a]
-            keys_b = [node_keys.get(c) for c in children_b]
+            # A node's key already carries its children's keys in child
+            # order, so one lookup per parent replaces one per child
+            keys_a = node_keys[node_a][3]
+            keys_b = node_keys[node_b][3]
 
             matcher = difflib.SequenceMatcher(None, keys_a, keys_b)
             has_child_changes = False
@@ -262,65 +310,126 @@ class FilterModule(object):
                 
             return (out_a, out_b, True)
 
-        def mark_tree(element, style):
-            if element is None: return
-            if element.text and element.text.strip():
-                element.text = '<span style="{} font-weight:bold;">{}</span>'.format(style, escape_html(element.text))
-            
-            element.set('__diff_style__', style)
-            for child in element:
-                mark_tree(child, style)
+        # Removed/added subtrees are not copied: the output tree only gets a
+        # placeholder, and serialize_marked() renders the original nodes
+        marked_nodes = {}
+
+        def marked(element, style):
+            if element is None: return None
+            placeholder = ET.Element('__marked__', style=style)
+            marked_nodes[placeholder] = element
+            return placeholder
 
         result_left, result_right, any_change = compare_nodes(root_before, root_after)
 
         # 3. Custom Serializer (Same as before)
-        def serialize(elem, level=0):
-            if elem is None: return ""
-            
-            if elem.tag == "__spacer__":
-                lines = int(elem.get('lines', 1))
-                return "".join(['<div class="spacer">&nbsp;</div>' for _ in range(lines)])
+        # Fragments are appended to a shared list and joined once at the
+        # end. The walk uses an explicit stack; closing markup is pushed
+        # as a plain string so it is emitted after the element's children.
+        def format_attrs(elem):
+            return "".join(
+                ' {}="{}"'.format(k, escape_html(v).replace('"', '&quot;'))
+                for k, v in elem.attrib.items() if not k.startswith('__')
+            )
 
-            indent_style = "padding-left: {}px;".format(level * 20)
-            
-            attrs = ""
-            for k, v in elem.attrib.items():
-                if not k.startswith('__'):
-                    val = escape_html(v).replace('"', '&quot;')
-                    attrs += ' {}="{}"'.format(k, val)
-            
-            tag = elem.tag
-            diff_style = elem.get('__diff_style__')
-            tag_style = diff_style if diff_style else "color: #6b7280;"
+        # Renders a removed/added subtree straight from the source tree:
+        # every tag carries the diff style and non-blank text is wrapped
+        # in a bold span of the same colour
+        def serialize_marked(root, level, style, out):
+            stack = [(root, level)]
+            while stack:
+                item = stack.pop()
+                if isinstance(item, str):
+                    out.append(item)
+                    continue
+                elem, level = item
+
+                tag = elem.tag
+                attrs = format_attrs(elem)
+                indent_style = _div_style(level)
+                start_tag_html = '<span style="{}">&lt;{}{}&gt;</span>'.format(style, tag, attrs)
+                end_tag_html = '<span style="{}">&lt;/{}&gt;</span>'.format(style, tag)
+
+                text = elem.text
+                if text and text.strip():
+                    text_html = '<span style="{} font-weight:bold;">{}</span>'.format(style, escape_html(text))
+                else:
+                    text_html = None
+
+                if len(elem) == 0:
+                    if text_html is None:
+                        text_html = '<span style="color: #374151;">{}</span>'.format(text or "")
+                    out.append('<div style="{}">{}{}{}</div>'.format(indent_style, start_tag_html, text_html, end_tag_html))
+                    continue
+
+                out.append('<div style="{}">{}</div>'.format(indent_style, start_tag_html))
+                if text_html is not None:
+                    out.append('<div style="{}">{}</div>'.format(_div_style(level + 1), text_html))
+                stack.append('<div style="{}">{}</div>'.format(indent_style, end_tag_html))
+                stack.extend((child, level + 1) for child in reversed(elem))
+
+        def serialize_into(root, out):
+            stack = [(root, 0)]
+            while stack:
+                item = stack.pop()
+                if isinstance(item, str):
+                    out.append(item)
+                    continue
+                elem, level = item
+
+                if elem.tag == "__spacer__":
+                    lines = int(elem.get('lines', 1))
+                    out.append('<div class="spacer">&nbsp;</div>' * lines)
+                    continue
+
+                if elem.tag == "__marked__":
+                    serialize_marked(marked_nodes[elem], level, elem.get('style'), out)
+                    out.append('<div class="spacer">&nbsp;</div>' * int(elem.get('__append_spacer__', 0)))
+                    continue
+
+                attrs = format_attrs(elem)
             
-            start_tag_html = '<span style="{}">&lt;{}{}&gt;</span>'.format(tag_style, tag, attrs)
-            end_tag_html = '<span style="{}">&lt;/{}&gt;</span>'.format(tag_style, tag)
+                tag = elem.tag
+                diff_style = elem.get('__diff_style__')
+                indent_style = _div_style(level, plain=not diff_style)
+
+                # Changed tags keep their own styled span (the report CSS
+                # highlights those); plain tags inherit gray from the div
+                if diff_style:
+                    start_tag_html = '<span style="{}">&lt;{}{}&gt;</span>'.format(diff_style, tag, attrs)
+                    end_tag_html = '<span style="{}">&lt;/{}&gt;</span>'.format(diff_style, tag)
+                else:
+                    start_tag_html = '&lt;{}{}&gt;'.format(tag, attrs)
+                    end_tag_html = '&lt;/{}&gt;'.format(tag)
             
-            append_spacer = int(elem.get('__append_spacer__', 0))
-            spacer_html = "".join(['<div class="spacer">&nbsp;</div>' for _ in range(append_spacer)])
-
-            if len(elem) == 0:
-                text = elem.text or ""
-                content_html = text
-                if not content_html.startswith('<span'):
-                    content_html = '<span style="color: #374151;">{}</span>'.format(content_html)
-                return '<div style="{}">{}{}{}</div>{}'.format(indent_style, start_tag_html, content_html, end_tag_html, spacer_html)
+                append_spacer = int(elem.get('__append_spacer__', 0))
+                spacer_html = '<div class="spacer">&nbsp;</div>' * append_spacer
+
+                if len(elem) == 0:
+                    text = elem.text or ""
+                    content_html = text
+                    if not content_html.startswith('<span'):
+                        content_html = '<span style="color: #374151;">{}</span>'.format(content_html)
+                    out.append('<div style="{}">{}{}{}</div>{}'.format(indent_style, start_tag_html, content_html, end_tag_html, spacer_html))
+                    continue
             
-            out = '<div style="{}">{}</div>'.format(indent_style, start_tag_html)
+                out.append('<div style="{}">{}</div>'.format(indent_style, start_tag_html))
             
-            if elem.text and elem.text.strip():
-                text_indent = "padding-left: {}px;".format((level * 20) + 20)
-                text_content = elem.text.strip()
-                if not text_content.startswith('<span'):
-                    text_content = '<span style="color: #374151;">{}</span>'.format(text_content)
-                out += '<div style="{}">{}</div>'.format(text_indent, text_content)
-                
-            for child in elem:
-                out += serialize(child, level + 1)
+                if elem.text and elem.text.strip():
+                    text_indent = _div_style(level + 1)
+                    text_content = elem.text.strip()
+                    if not text_content.startswith('<span'):
+                        text_content = '<span style="color: #374151;">{}</span>'.format(text_content)
+                    out.append('<div style="{}">{}</div>'.format(text_indent, text_content))
                 
-            out += '<div style="{}">{}</div>'.format(indent_style, end_tag_html)
-            out += spacer_html
-            return out
+                stack.append('<div style="{}">{}</div>{}'.format(indent_style, end_tag_html, spacer_html))
+                stack.extend((child, level + 1) for child in reversed(elem))
+
+        def serialize(elem):
+            if elem is None: return ""
+            buf = []
+            serialize_into(elem, buf)
+            return "".join(buf)
             
         left_out = serialize(result_left)
         right_out = serialize(result_right)
@@ -1,112 +1,293 @@
-from xmldiff import main, formatting
+from xmldiff import main, formatting, actions
 from lxml import etree
-import json
-import io
+from functools import lru_cache
+from copy import deepcopy
+from hashlib import blake2b
+from concurrent.futures import ThreadPoolExecutor
+import threading
 
+# orjson is only needed for tostring(); fall back to json without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    import json
+
+# Copies a document into the null namespace: elements and attributes keep
+# their local names only, comments and PIs are copied as they are
+_STRIP_NS_XSL = b"""\
+<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+  <xsl:template match="*">
+    <xsl:element name="{local-name()}">
+      <xsl:for-each select="@*">
+        <xsl:attribute name="{local-name()}"><xsl:value-of select="."/></xsl:attribute>
+      </xsl:for-each>
+      <xsl:apply-templates/>
+    </xsl:element>
+  </xsl:template>
+  <xsl:template match="comment()|processing-instruction()">
+    <xsl:copy/>
+  </xsl:template>
+</xsl:stylesheet>
+"""
+
+# Whether any element or attribute in the document is namespaced
+_HAS_NS_XPATH = "boolean(//*[namespace-uri()] | //@*[namespace-uri()])"
+
+_local = threading.local()
+
+def _parse_tools():
+    """
+    Returns this thread's parser, namespace check and stripping transform,
+    built on first use. lxml parsers must not be shared between threads.
+    """
+    tools = getattr(_local, "tools", None)
+    if tools is None:
+        tools = _local.tools = (
+            etree.XMLParser(remove_blank_text=True, huge_tree=True, collect_ids=False),
+            etree.XPath(_HAS_NS_XPATH),
+            etree.XSLT(etree.XML(_STRIP_NS_XSL)),
+        )
+    return tools
+
+def _as_bytes(xml):
+    """Returns the document as UTF-8 bytes, encoding it only if needed."""
+    return xml if isinstance(xml, bytes) else xml.encode("utf-8")
+
+# Playbooks often diff the same document against many others, so recent
+# trees are kept per input string. They are shared between calls: xmldiff
+# diffs a copy of the left tree and only strips comments from the inputs,
+# which makes no difference the second time around
+@lru_cache(maxsize=16)
 def parse_without_ns(xml_str):
     """
     Robust namespace-stripping XML parser for NETCONF/YANG data.
     Ensures the final root element is returned correctly.
+    Takes the document as str or bytes.
     """
 
-    # Streaming parse
-    it = etree.iterparse(
-        io.BytesIO(xml_str.encode("utf-8")),
-        events=("start", "end"),
-        remove_blank_text=True
-    )
+    parser, has_ns, strip_ns = _parse_tools()
 
-    root = None
+    # Parse and strip in C (libxml2/libxslt), no per-element Python work
+    doc = etree.fromstring(_as_bytes(xml_str), parser)
 
-    for event, el in it:
+    # Nothing to strip: skip the copy. Checking the root's nsmap is not
+    # enough, as namespaces may be declared further down
+    if not has_ns(doc):
+        return doc
 
-        # Capture root on the first 'start' event
-        if event == "start" and root is None:
-            root = el
+    return strip_ns(doc).getroot()
 
-        # Remove element namespace
-        if '}' in el.tag:
-            el.tag = el.tag.split('}', 1)[1]
+def _subtree_digests(root):
+    """
+    Digest of every element's subtree (tag, attributes, text, tail and
+    children), built bottom-up so each node is hashed once.
+    """
+    digests = {}
+    # Reversed document order visits children before their parents
+    for el in reversed(list(root.iter())):
+        h = blake2b(digest_size=16)
+        h.update(repr((el.tag if isinstance(el.tag, str) else None,
+                       sorted(el.attrib.items()), el.text, el.tail)).encode("utf-8"))
+        for child in el:
+            h.update(digests[child])
+        digests[el] = h.digest()
+    return digests
+
+def _collapse_shared(before_doc, after_doc, before_digests, after_digests):
+    """
+    Returns copies of both trees in which every subtree found unchanged at
+    the same path on both sides is cut down to its top element (or the
+    trees themselves when there is nothing to cut).
+
+    The top element keeps its tag, attributes and text, so paths and
+    positions stay the same and xmldiff still matches it; it just has no
+    identical descendants left to compare.
+    """
+    after_tree = after_doc.getroottree()
+    shared = {
+        (after_tree.getpath(el), digest): el
+        for el, digest in after_digests.items() if len(el)
+    }
 
-        # Remove attribute namespaces
-        new_attrs = {}
-        for attr, val in el.attrib.items():
-            if '}' in attr:
-                attr = attr.split('}', 1)[1]
-            new_attrs[attr] = val
+    before_tree = before_doc.getroottree()
+    cut = []
+    stack = [before_doc]
+    while stack:
+        el = stack.pop()
+        if not len(el):
+            continue
+        match = shared.get((before_tree.getpath(el), before_digests[el]))
+        if match is None:
+            stack.extend(el)
+        else:
+            cut.append((el, match))
 
-        el.attrib.clear()
-        el.attrib.update(new_attrs)
+    if not cut:
+        return before_doc, after_doc
 
-    return root
+    # The parsed trees are cached: cut the copies
+    before = deepcopy(before_doc)
+    after = deepcopy(after_doc)
+    before_copies = dict(zip(before_doc.iter(), before.iter()))
+    after_copies = dict(zip(after_doc.iter(), after.iter()))
+    for el, match in cut:
+        del before_copies[el][:]
+        del after_copies[match][:]
+    return before, after
 
 class StructuredFormatter(formatting.XMLFormatter):
 
     def __init__(self):
         super().__init__()
+        # append() adds to the lists directly; output holds the same lists
+        self._added = []
+        self._deleted = []
+        self._changed = []
+        self._moved = []
         self.output = {
-            "added": [],
-            "deleted": [],
-            "changed": [],
-            "moved": []
+            "added": self._added,
+            "deleted": self._deleted,
+            "changed": self._changed,
+            "moved": self._moved
         }
 
         # Prevent namespace lookup inside xmldiff
         self.namespaces = {}
 
-    def append(self, op, node):
-
-        if op == "insert":
-            # node is a tuple (path, xml-string, position)
-            path = node[0]
-            self.output["added"].append(path)
-
-        elif op == "delete":
-            path = node[0]
-            self.output["deleted"].append(path)
-
-        elif op == "update":
-            path = node[0]
-            old_val = node[1]
-            new_val = node[2]
-            self.output["changed"].append({
-                "path": path,
-                "old": old_val,
-                "new": new_val
+    def format(self, diff, orig_tree, differ=None):
+        # Collect the records instead of rendering an annotated tree
+        for action in diff:
+            self.append(action)
+        return self.output
+
+    def append(self, action):
+        kind = type(action)
+
+        if kind is actions.InsertNode:
+            # The new node is the position'th child of the target
+            self._added.append("{}/*[{}]".format(action.target, action.position + 1))
+
+        elif kind is actions.DeleteNode:
+            self._deleted.append(action.node)
+
+        elif kind is actions.UpdateTextIn:
+            self._changed.append({
+                "path": action.node,
+                "old": action.oldtext,
+                "new": action.text
             })
 
-        elif op == "move":
-            self.output["moved"].append(node)
+        elif kind is actions.UpdateTextAfter:
+            self._changed.append({
+                "path": action.node + "/following-sibling::text()[1]",
+                "old": action.oldtext,
+                "new": action.text
+            })
+
+        elif kind is actions.RenameNode:
+            self._changed.append({
+                "path": action.node,
+                "old": None,
+                "new": action.tag
+            })
+
+        elif kind in (actions.UpdateAttrib, actions.InsertAttrib):
+            # xmldiff does not carry the old value of an attribute
+            self._changed.append({
+                "path": "{}/@{}".format(action.node, action.name),
+                "old": None,
+                "new": action.value
+            })
+
+        elif kind is actions.DeleteAttrib:
+            self._changed.append({
+                "path": "{}/@{}".format(action.node, action.name),
+                "old": None,
+                "new": None
+            })
+
+        elif kind is actions.RenameAttrib:
+            self._changed.append({
+                "path": "{}/@{}".format(action.node, action.oldname),
+                "old": action.oldname,
+                "new": action.newname
+            })
+
+        elif kind is actions.MoveNode:
+            self._moved.append({
+                "path": action.node,
+                "target": action.target,
+                "position": action.position
+            })
+
+    def to_dict(self):
+        return self.output
 
     def tostring(self):
+        if orjson is not None:
+            return orjson.dumps(self.output, option=orjson.OPT_INDENT_2).decode()
         return json.dumps(self.output, indent=2)
 
 
-def structured_xml_diff(before_xml, after_xml):
+def structured_xml_diff(before_xml, after_xml, F=0.5, ratio_mode="fast",
+                        fast_match=False, uniqueattrs=(),
+                        collapse_shared=False):
+    """
+    Diffs two XML documents with xmldiff. F, ratio_mode, fast_match and
+    uniqueattrs are passed on to xmldiff's Differ. The defaults are the
+    options this filter has always used; large NETCONF configs can opt in
+    to speed, e.g. F=0.75, fast_match=True and uniqueattrs=["name", "key"]
+    where list entries are identified by key attributes.
+
+    collapse_shared cuts subtrees that are unchanged at the same path out
+    of both trees first. That saves xmldiff most of its work on large,
+    mostly equal documents, but also changes what its similarity
+    heuristics see, so it can pick different (still valid) edits.
+    """
 
-    before_doc = parse_without_ns(before_xml)
-    after_doc = parse_without_ns(after_xml)
+    # The two documents are parsed side by side; libxml2 and libxslt
+    # release the GIL while they work. The pool lives for this call only:
+    # Ansible forks its workers, and a forked child cannot use threads
+    # started in its parent
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="xmldiff-parse") as pool:
+        before_job = pool.submit(parse_without_ns, before_xml)
+        after_doc = parse_without_ns(after_xml)
+        before_doc = before_job.result()
+    before_digests = _subtree_digests(before_doc)
+    after_digests = _subtree_digests(after_doc)
+
+    # Equal documents: nothing for xmldiff to find
+    if before_digests[before_doc] == after_digests[after_doc]:
+        return {"added": [], "deleted": [], "changed": [], "moved": []}
+
+    if collapse_shared:
+        before_doc, after_doc = _collapse_shared(
+            before_doc, after_doc, before_digests, after_digests
+        )
 
     formatter = StructuredFormatter()
 
-    # IMPORTANT: disable namespace-dependent algorithms in xmldiff
-    diff = main.diff_trees(
+    # Namespaces are stripped, so uniqueattrs are plain attribute names
+    return main.diff_trees(
         before_doc,
         after_doc,
         formatter=formatter,
         diff_options={
-            "F": 0.5,
-            "ratio_mode": "fast",
-            "uniqueattrs": [],        # disable namespace-based uniqueness
-            "explicit_namespaces": {},# disable namespace resolution
+            "F": F,
+            "ratio_mode": ratio_mode,
+            "fast_match": fast_match,
+            "uniqueattrs": list(uniqueattrs),
         }
     )
 
-    return json.loads(formatter.tostring())
-
 
 class FilterModule(object):
     def filters(self):
         return {
             "xml_structured_diff": structured_xml_diff
         }
+
+    def cache_clear(self):
+        """Drops the parsed trees kept between calls."""
+        parse_without_ns.cache_clear()